@@ -0,0 +1,139 @@
+""" Structured access log for AlbumServer.
+
+    http.server's handler writes a line to stderr for every request, from
+    the thread that handled it, so a slow console (or a paused terminal)
+    holds up the requests. Instead each request is recorded as one JSON
+    object per line, with the fields:
+
+        time      when the request arrived (seconds since 1970)
+        client    the client's IP address
+        method    GET, POST...
+        path      the path asked for (after any /t/<tenant> prefix)
+        tenant    the tenant (tenant mode), or null
+        status    the status code sent
+        bytes     size of the response body
+        ms        time taken to handle the request, in milliseconds
+        cache     "hit" or "miss" for pages that can come from the page
+                  cache (a hit includes 304 Not Modified), "skip" for
+                  profiled requests, or null
+
+    record() only puts the entry in a queue. Every flush_interval seconds a
+    background thread writes the entries that have collected in one go, so
+    request threads never wait on the disk or the console. Other messages
+    (eg http.server's error messages) go through the same thread to stderr.
+
+    The log can be replayed against a server with replay.py.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+
+# hardcoded global parameters
+flush_interval = 1.0            # seconds between flushes of the log file
+max_queued = 100000             # entries waiting to be written before new ones are dropped
+
+class AccessLog:
+    """Writes access log entries and messages from a background thread
+
+       Parameters:
+       file_name: file the entries are appended to, or "-" for stderr
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        if file_name == "-":
+            self.file = sys.stderr
+        else:
+            directory = os.path.dirname(file_name)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # each batch is written with one write call, so worker processes
+            # appending to the same file don't mix up their lines
+            self.file = open(file_name, "a", encoding="utf-8")
+        self.entries = queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="access-log", daemon=True)
+        self.thread.start()
+
+    def record(self, time, client, method, path, tenant, status, response_bytes, seconds, cache):
+        """queue an entry for a handled request"""
+        self.put({"time": round(time, 3), "client": client, "method": method, "path": path,
+                  "tenant": tenant, "status": status, "bytes": response_bytes,
+                  "ms": round(seconds * 1000, 3), "cache": cache})
+
+    def message(self, text):
+        """queue a line for stderr"""
+        self.put(text)
+
+    def put(self, item):
+        try:
+            self.entries.put_nowait(item)
+        except queue.Full:
+            # the disk can't keep up. Losing log lines is better than making
+            # every request wait.
+            self.dropped += 1
+
+    def close(self):
+        """write everything queued, then stop the background thread"""
+        self.closing.set()
+        self.thread.join()
+        if self.file is not sys.stderr:
+            self.file.close()
+
+    def run(self):
+        # entries collect for flush_interval, then are written in one go
+        while True:
+            closing = self.closing.wait(flush_interval)
+            self.write_waiting()
+            if closing:
+                break
+
+    def write_waiting(self):
+        """write (and flush) everything in the queue"""
+        lines = []
+        messages = []
+        while True:
+            try:
+                item = self.entries.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, str):
+                messages.append(item + "\n")
+            else:
+                lines.append(json.dumps(item, separators=(",", ":")) + "\n")
+        if messages:
+            sys.stderr.write("".join(messages))
+            sys.stderr.flush()
+        if lines:
+            self.file.write("".join(lines))
+            self.file.flush()
+
+def read_log(file_name):
+    """the entries in an access log, skipping any lines that aren't entries
+
+       Returns: generator of entry dictionaries, in the order they were written
+    """
+    with open(file_name, encoding="utf-8") as log_file:
+        for line in log_file:
+            if not line.startswith("{"):
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
@@ -14,91 +14,448 @@
     GNU General Public License for more details.
 """
 
-import sys
 import os.path
+import queue
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from sqlite3 import Error
+import db_writer
+import metrics
+import migrations
+import query_profiler
+import snapshot
+
+# queries shared by the get_* (fetch everything) and iter_* (stream) methods
+# The album listings read AlbumListing, which holds every album already
+# joined with its artist and label (see migration 3 in migrations.py)
+albums_query = """
+    select albumID, album_title, artist_name, year, label_name, price
+    from AlbumListing
+    order by album_title
+    """
+
+artists_query = "select artistID, artist_name, city, state from Artists order by artist_name"
+
+tracks_query = """
+    select tracknum, track_title, length
+    from Tracks
+    where Tracks.albumRef = ?
+    order by tracknum
+    """
+
+labels_query = "select record_labelID, label_name from RecordLabels order by label_name"
+
+# columns, tables and sort orders for the paged listings (see keyset_page).
+# Rows are always ordered by the sort column and then by ID, so the order is
+# well defined even when the sort column has duplicates.
+album_columns = "albumID, album_title, artist_name, year, label_name, price"
+album_tables = "AlbumListing"
+album_sorts = {"title": "album_title", "artist": "artist_name", "year": "year", "price": "price"}
+
+artist_columns = "artistID, artist_name, city, state"
+artist_sorts = {"name": "artist_name"}
+
+label_columns = "record_labelID, label_name"
+label_sorts = {"name": "label_name"}
+
+# what a CatalogSearch row is: rowid % 4 (see migration 2 in migrations.py)
+search_kinds = {0: "Album", 1: "Artist", 2: "Label", 3: "Track"}
+
+# bulk track loads (add_tracks): track lengths can be m:ss or decimal minutes
+track_length_re = re.compile(r"^\d{1,3}(:[0-5]\d|\.\d+)?$")
+max_track_errors = 1000         # errors reported per load, the rest are only counted
+
+# best matches first (FTS5's rank is bm25). The album is looked up for tracks
+# so the results can link to the album's track list.
+search_query = """
+    select CatalogSearch.rowid % 4, CatalogSearch.rowid / 4, title, Tracks.albumRef
+    from CatalogSearch left join Tracks
+        on CatalogSearch.rowid % 4 = 3 and Tracks.trackID = CatalogSearch.rowid / 4
+    where CatalogSearch match ?
+    order by rank
+    limit ? offset ?
+    """
+
+def search_expression(text):
+    """Turn what the user typed into an FTS5 query: every word must match,
+       and the last word can be the start of a word (type-ahead). Words are
+       quoted so FTS5 operators (AND, NEAR, *, etc) typed by the user are
+       just searched for. Returns None if there are no words to search for.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join('"' + word + '"' for word in words) + "*"
+
+def keyset_query(columns, tables, id_column, sort_column, reverse, cursor_id, limit):
+    """Build the query for one page of a listing (see albumsDB.keyset_page)
+    
+       Params:
+           columns, tables, id_column, sort_column: see keyset_page
+           reverse: True to read the rows from highest to lowest
+           cursor_id: ID of the row to start after (or None for the first page)
+           limit: number of rows to read
+    
+       Returns: (query, params)
+    """
+    order = "desc" if reverse else "asc"
+    compare = "<" if reverse else ">"
+    
+    query = "select " + columns + " from " + tables
+    params = []
+    if cursor_id is not None:
+        query += (" where (" + sort_column + ", " + id_column + ") " + compare +
+                  " (select " + sort_column + ", " + id_column + " from " + tables +
+                  " where " + id_column + " = ?)")
+        params.append(cursor_id)
+    query += (" order by " + sort_column + " " + order + ", " + id_column + " " + order +
+              " limit ?")
+    params.append(limit)
+    return query, params
 
 class albumsDB:
     """database access methods for Albums database
     
        Parameters:
        mydb_file: path/name to sqlite3 database file
+       pool_size: number of connections kept in the connection pool. Use one
+                  connection per server worker thread.
+       profiler: a query_profiler.QueryProfiler to time every statement, or
+                 None (the default) for no profiling
+      
+       Each thread that calls one of the database methods checks a connection
+       (and its cursor) out of the pool for the duration of the call, so the
+       same albumsDB object can be shared by all worker threads. If every
+       connection is in use the caller waits until one is handed back.
+       
+       The database is in WAL mode, so reads never wait for writes. All
+       writes (the add_* methods) are handed to a single writer thread with
+       its own connection, which commits the writes waiting at the same time
+       in one transaction (see db_writer.py).
+       
+       Every successful write bumps a data generation counter, and so does a
+       write made by another connection or process (eg another prefork
+       worker, or snapshot.py restoring a snapshot). Callers that cache
+       anything built from the database (eg rendered pages) can compare
+       data_generation() with the value they saw when the cache was filled.
       
        TO DO:
        * Wrap database tranactions in try/catch blocks
        * Figure out how to display warnings/errors in browser
     """
     
-    def __init__(self, mydb_file):
+    def __init__(self, mydb_file, pool_size=1, profiler=None):
         self.db_file = mydb_file
+        self.pool_size = pool_size
+        self.pool = None
+        self.profiler = profiler
+        
+        # data generation, bumped after every write, and the DataVersion
+        # row (token, changed time) read for it (see data_stamp)
+        self.generation = 0
+        self.stamp = None
+        self.stamp_generation = None
+        self.generation_lock = threading.Lock()
+        self.watch_conn = None
+        self.watch_version = None
+        self.writer = None
+        
+        # connection checked out by the current thread (if any)
+        self.local = threading.local()
         
         # make sure database file exists
         if not os.path.exists(self.db_file):
-            sys.exit("Database file " + self.db_file + " not found. Program exiting.")
+            raise FileNotFoundError("Database file " + self.db_file + " not found")
         
     def connect(self):
-        """Create a database connection to the SQLite database
-           specified by the db_file. Exit if connection fails.
+        """Fill the connection pool with pool_size connections to the SQLite 
+           database specified by the db_file, after applying any schema 
+           migrations the database needs (see migrations.py). Raises 
+           sqlite3.Error if the database can't be opened, after closing any
+           connections that were opened.
         """
-        self.conn = None
+        self.pool = queue.Queue(maxsize=self.pool_size)
         try:
-            self.conn = sqlite3.connect(self.db_file)
-            self.cursor = self.conn.cursor()
-        except Error as e:
-            print(e)
-            sys.exit("Unable to open database " + self.db_file + ". Program exiting.")
+            # bring the schema up to date before anything else uses it
+            conn = self.open_connection()
+            try:
+                self.schema_version = migrations.apply_migrations(conn, verbose=True)
+                # WAL mode is stored in the database file, so this only
+                # changes anything the first time
+                conn.execute("PRAGMA journal_mode = WAL")
+            finally:
+                conn.close()
+            
+            for i in range(self.pool_size):
+                self.pool.put(self.open_connection())
+            self.writer = db_writer.DatabaseWriter(self.open_connection(), self.bump_generation,
+                                                   migrations.stamp_data_version)
+            # PRAGMA data_version on a connection that never writes changes
+            # whenever any other connection (or process) commits
+            self.watch_conn = self.open_connection()
+            self.watch_version = self.watch_conn.execute("PRAGMA data_version").fetchone()[0]
+        except Error:
+            self.closeDB()
+            raise
+            
+    def open_connection(self):
+        """Open a single connection to db_file. Connections are passed between
+           worker threads by the pool, so sqlite3's same-thread check is turned
+           off. A connection is only ever used by one thread at a time.
+        """
+        if self.profiler is None:
+            return sqlite3.connect(self.db_file, check_same_thread=False)
+        conn = sqlite3.connect(self.db_file, check_same_thread=False,
+                               factory=query_profiler.ProfiledConnection)
+        conn.attach(self.profiler)
+        return conn
+            
+    @contextmanager
+    def session(self):
+        """Check a connection out of the pool and yield a cursor for it. The
+           connection is returned to the pool when the with block ends. Nested
+           sessions in the same thread reuse the connection already checked out.
+        """
+        if getattr(self.local, "cursor", None) is not None:
+            yield self.local.cursor
+            return
+        
+        conn = self.pool.get()
+        self.local.cursor = conn.cursor()
+        try:
+            yield self.local.cursor
+        finally:
+            self.local.cursor.close()
+            self.local.cursor = None
+            self.pool.put(conn)
             
     def closeDB(self):
-        self.cursor.close()
-        self.conn.close()
+        """Finish any queued writes and close every connection"""
+        if self.writer is not None:
+            self.writer.close()
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        if self.watch_conn is not None:
+            self.watch_conn.close()
+            
+    @metrics.timed
+    def restore(self, snapshot_file):
+        """Replace the contents of the database with a snapshot (see
+           snapshot.py). The writer thread does the restore between write
+           transactions, so no write is half done, and the pooled connections
+           see the restored data on their next query.
+        
+           Params:
+               snapshot_file: the snapshot to restore
+               
+           Returns: the schema version
+        """
+        self.schema_version = self.writer.call(snapshot.restore_into, snapshot_file)
+        return self.schema_version
+            
+    def bump_generation(self):
+        """record that the data in the database has changed"""
+        with self.generation_lock:
+            self.generation += 1
+            
+    def data_generation(self):
+        """Return a number that changes whenever the data in the database
+           changes, including writes made by other processes.
+        """
+        with self.generation_lock:
+            version = self.watch_conn.execute("PRAGMA data_version").fetchone()[0]
+            if version != self.watch_version:
+                self.watch_version = version
+                self.generation += 1
+        return self.generation
+        
+    def data_stamp(self):
+        """Return (token, changed time) from the DataVersion table: a random
+           token that every write replaces and when that write happened (see
+           migrations.stamp_data_version). Unlike the data generation they 
+           are kept in the database, so every process (eg prefork workers) 
+           sees the same ones. They are only read again after the data 
+           generation has changed, so call data_generation() first.
+        """
+        with self.generation_lock:
+            if self.stamp_generation != self.generation:
+                self.stamp = self.watch_conn.execute(
+                    "select token, changed_time from DataVersion").fetchone()
+                self.stamp_generation = self.generation
+            return self.stamp
+        
+    def iter_rows(self, query, params=(), batch_size=500):
+        """Run query and yield its rows one at a time, fetching batch_size rows
+           from SQLite at a time, so the whole result set is never in memory.
+           The connection stays checked out until the generator is exhausted
+           or closed, so close it if you stop early.
+        """
+        with self.session() as cursor:
+            # own cursor, so other queries on this connection don't reset it
+            batch_cursor = cursor.connection.cursor()
+            try:
+                batch_cursor.execute(query, params)
+                while True:
+                    rows = batch_cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                batch_cursor.close()
+        
+    def keyset_page(self, columns, tables, id_column, sort_column, descending,
+                    after, before, page_size):
+        """Get one page of a listing using keyset (seek) pagination. Instead
+           of skipping rows with OFFSET, the query starts right after (or 
+           before) the row the previous page ended on, so with an index on
+           (sort_column, id_column) every page costs the same no matter how 
+           far into the listing it is.
         
+           Params:
+               columns, tables: select list and from clause of the listing
+               id_column: unique ID of a row, used as the tie breaker
+               sort_column: column the listing is sorted on
+               descending: True to sort from highest to lowest
+               after: ID of the last row of the previous page (or None)
+               before: ID of the first row of the next page, to page
+                       backwards (or None)
+               page_size: number of rows per page
+               
+           Returns: (rows, has_prev, has_next)
+        """
+        backwards = before is not None
+        cursor_id = before if backwards else after
+        
+        # paging backwards reads the rows in the opposite order, then flips them.
+        # One extra row tells us if there is another page.
+        query, params = keyset_query(columns, tables, id_column, sort_column,
+                                     descending != backwards, cursor_id, page_size + 1)
+        
+        with self.session() as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            
+        more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backwards:
+            rows.reverse()
+            return rows, more, True
+        return rows, cursor_id is not None, more
+        
+    @metrics.timed
+    def get_albums_page(self, sort="title", descending=False, after=None, before=None, page_size=50):
+        """Get one page of albums. sort is one of album_sorts (title, artist,
+           year, price). See keyset_page for the other parameters.
+        """
+        return self.keyset_page(album_columns, album_tables, "albumID",
+                                album_sorts[sort], descending, after, before, page_size)
+        
+    @metrics.timed
+    def get_artists_page(self, sort="name", descending=False, after=None, before=None, page_size=50):
+        """Get one page of artists, see keyset_page"""
+        return self.keyset_page(artist_columns, "Artists", "artistID",
+                                artist_sorts[sort], descending, after, before, page_size)
+        
+    @metrics.timed
+    def get_labels_page(self, sort="name", descending=False, after=None, before=None, page_size=50):
+        """Get one page of record labels, see keyset_page"""
+        return self.keyset_page(label_columns, "RecordLabels", "record_labelID",
+                                label_sorts[sort], descending, after, before, page_size)
+        
+    @metrics.timed
+    def search(self, text, page=1, page_size=20):
+        """Full text search of album titles, artist names, label names and
+           track titles, best matches first (bm25 ranking).
+        
+           Params:
+               text: words to search for, the last one can be partial
+               page: page of results, starting at 1
+               page_size: results per page
+               
+           Returns: (rows, has_next). Each row is (kind, ID, title, albumID), 
+                    kind is a key of search_kinds, albumID is only set for 
+                    tracks.
+        """
+        expression = search_expression(text)
+        if expression is None:
+            return [], False
+        
+        # Ranked results have to be sorted by score anyway, so a page is read
+        # with OFFSET rather than by seeking like the listings do
+        with self.session() as cursor:
+            cursor.execute(search_query, (expression, page_size + 1, (page - 1) * page_size))
+            rows = cursor.fetchall()
+        return rows[:page_size], len(rows) > page_size
+        
+    @metrics.timed
     def get_albums(self):
         """Query all rows in the tasks table
            TO DO: handle empty table situation
         """
-        
-        self.cursor.execute("""
-        select albumID, album_title, artist_name, year, label_name, price
-        from Albums, Artists, RecordLabels
-        where Albums.artistRef = Artists.artistID AND
-        Albums.record_labelRef = RecordLabels.record_labelID
-        order by album_title
-        """)
-        
-        rows = self.cursor.fetchall()
+        with self.session() as cursor:
+            cursor.execute(albums_query)
+            
+            rows = cursor.fetchall()
         return rows
     
+    @metrics.timed
+    def iter_albums(self, batch_size=500):
+        """Same rows as get_albums, streamed in batches"""
+        return self.iter_rows(albums_query, (), batch_size)
+    
+    @metrics.timed
     def get_artists(self):
-        self.cursor.execute("select artistID, artist_name, city, state from Artists order by artist_name") 
-        
-        rows = self.cursor.fetchall()
+        with self.session() as cursor:
+            cursor.execute(artists_query) 
+            
+            rows = cursor.fetchall()
         return rows
     
+    @metrics.timed
+    def iter_artists(self, batch_size=500):
+        """Same rows as get_artists, streamed in batches"""
+        return self.iter_rows(artists_query, (), batch_size)
+    
+    @metrics.timed
     def get_tracks(self, albumID):
         """Get all tracks for a given albumID
         
            Params:
                albumID: ID of album to get tracks for
         """
-        self.cursor.execute("""
-        select tracknum, track_title, length
-        from Tracks
-        where Tracks.albumRef = ?
-        order by tracknum
-        """, (albumID,))
-         
-        rows = self.cursor.fetchall()
+        with self.session() as cursor:
+            cursor.execute(tracks_query, (albumID,))
+             
+            rows = cursor.fetchall()
         return rows
     
+    @metrics.timed
+    def iter_tracks(self, albumID, batch_size=500):
+        """Same rows as get_tracks, streamed in batches"""
+        return self.iter_rows(tracks_query, (albumID,), batch_size)
+    
+    @metrics.timed
     def get_labels(self):
         """Get all record labels"""
         
-        self.cursor.execute("select record_labelID, label_name from RecordLabels order by label_name") 
-        
-        rows = self.cursor.fetchall()
+        with self.session() as cursor:
+            cursor.execute(labels_query) 
+            
+            rows = cursor.fetchall()
         return rows
     
+    @metrics.timed
+    def iter_labels(self, batch_size=500):
+        """Same rows as get_labels, streamed in batches"""
+        return self.iter_rows(labels_query, (), batch_size)
+    
+    @metrics.timed
     def add_album(self, new_fields):
         """Insert a new album into albums table
         
@@ -112,12 +469,9 @@ class albumsDB:
         labelID = new_fields.get('labelID')[0]
         price = new_fields.get('price')[0]
         
-        self.cursor.execute("""
-        insert into Albums (price, album_title, artistRef, year, record_labelRef)
-        values (?, ?, ?, ?, ?)""",
-        (price, album_title, artistID, year, labelID))
-        self.conn.commit()
+        self.writer.write(insert_album, (price, album_title, artistID, year, labelID))
         
+    @metrics.timed
     def add_track(self, new_fields):
         """Insert a single track into tracks table
         
@@ -131,12 +485,47 @@ class albumsDB:
         
         print("add track: albumID: " + albumID + " title: " + track_title)
         
-        self.cursor.execute("""
-        insert into Tracks (albumRef, tracknum, track_title, length)
-        values (?, ?, ?, ?)""",
-        (albumID, track_num, track_title, track_length))
-        self.conn.commit()
+        self.writer.write(insert_track, (albumID, track_num, track_title, track_length))
     
+    @metrics.timed
+    def add_tracks(self, rows):
+        """Insert many tracks in one transaction. Rows that fail validation
+           (or whose title is already in the database) are skipped and 
+           reported, the rest are still added. The rows are read and checked
+           here, in the calling thread, so the writer thread never waits on
+           reading an upload. Then all of the rows that passed are handed to
+           the writer thread at once, so either all of them are committed or
+           (if the commit fails) none of them are.
+        
+           Params:
+               rows: iterable of (row name, fields), fields are albumRef, 
+                     track num, track title, length as in 
+                     tracks_initial_load.csv, or an error message (str) for
+                     a row that couldn't be read. rows can be a generator; 
+                     it is read one row at a time.
+                     
+           Returns: (tracks added, number of errors, list of (row name, error)).
+                    Only the first max_track_errors errors are listed.
+        """
+        checked = []            # (row number, row name, values) that passed the checks
+        row_errors = []         # (row number, row name, error)
+        for number, (row_name, fields) in enumerate(rows):
+            values, error = check_track_fields(fields)
+            if error is None:
+                checked.append((number, row_name, values))
+            else:
+                row_errors.append((number, row_name, error))
+                
+        added = 0
+        if checked:
+            added, insert_errors = self.writer.write(insert_tracks, checked)
+            row_errors.extend(insert_errors)
+        # report the errors in the order of the rows
+        row_errors.sort()
+        errors = [(row_name, error) for number, row_name, error in row_errors[:max_track_errors]]
+        return added, len(row_errors), errors
+    
+    @metrics.timed
     def add_artist(self, new_fields):
         """Insert a new artist into artists table
         
@@ -148,18 +537,9 @@ class albumsDB:
         city = new_fields.get('city')[0]
         state = new_fields.get('state')[0]
         
-        # make sure artist does not exist in database already
-        self.cursor.execute("select artistID from artists where artist_name = ?", ([artist_name]))
-        artistID = self.cursor.fetchone()
-        
-        if artistID == None:
-            # artist does not exist in database, so add artist to the table
-            self.cursor.execute(
-            'insert into Artists (artist_name, city, state) values (?, ?, ?)', (artist_name, city, state))
-            self.conn.commit()
-        else:
-            print("Artist already exists in database")
+        self.writer.write(insert_artist, (artist_name, city, state))
             
+    @metrics.timed
     def add_label(self, new_fields):
         """Insert a new record label into record labels table
         
@@ -169,15 +549,89 @@ class albumsDB:
         # parse fields
         label_name = new_fields.get('label_name')[0]
         
-        # make sure label does not exist in database
-        self.cursor.execute("select record_labelID from RecordLabels where label_name = ?", ([label_name]))
-        labelID = self.cursor.fetchone()
-        
-        if labelID == None:
-            # label does not exist, so add it
-            self.cursor.execute(
-            'insert into RecordLabels (label_name) values (?)', ([label_name]))
-            self.conn.commit()
-        else:
-            print("Label already exists in database")
+        self.writer.write(insert_label, label_name)
+
+# Writes. These run in the writer thread (see db_writer.py), which commits
+# them, so they must not commit themselves.
+
+def insert_album(cursor, values):
+    cursor.execute("""
+    insert into Albums (price, album_title, artistRef, year, record_labelRef)
+    values (?, ?, ?, ?, ?)""", values)
+
+def insert_track(cursor, values):
+    cursor.execute("""
+    insert into Tracks (albumRef, tracknum, track_title, length)
+    values (?, ?, ?, ?)""", values)
+
+def check_track_fields(fields):
+    """Validate one row of a bulk track load (apart from whether its album
+       exists, which insert_tracks checks)
+    
+       Params:
+           fields: albumRef, track num, track title, length (strings), or an
+                   error message if the row couldn't be read
+           
+       Returns: (values to insert, None) or (None, error message)
+    """
+    if isinstance(fields, str):
+        return None, fields
+    if len(fields) < 4:
+        return None, "expected 4 fields: albumRef, track num, track title, length"
+    album, track_num, track_title, track_length = (field.strip() for field in fields[:4])
+    if not album.isdigit():
+        return None, "albumRef must be an album ID number"
+    if not track_num.isdigit() or int(track_num) < 1:
+        return None, "track number must be a whole number"
+    if not track_title:
+        return None, "track title is empty"
+    if not track_length_re.match(track_length):
+        return None, "length must be minutes:seconds or minutes (eg 4:05 or 4.08)"
+    return (int(album), int(track_num), track_title, track_length), None
+
+def insert_tracks(cursor, rows):
+    """Insert the checked tracks of a bulk load (see albumsDB.add_tracks)
+    
+       Params:
+           rows: list of (row number, row name, values from check_track_fields)
+           
+       Returns: (tracks added, list of (row number, row name, error))
+    """
+    added = 0
+    errors = []
+    albums = {}                 # albumID: exists
+    for number, row_name, values in rows:
+        album = values[0]
+        if album not in albums:
+            cursor.execute("select 1 from Albums where albumID = ?", (album,))
+            albums[album] = cursor.fetchone() is not None
+        if not albums[album]:
+            errors.append((number, row_name, "album " + str(album) + " does not exist"))
+            continue
+        try:
+            cursor.execute("""
+            insert into Tracks (albumRef, tracknum, track_title, length)
+            values (?, ?, ?, ?)""", values)
+            added += 1
+        except sqlite3.IntegrityError:
+            # only this insert is undone, the transaction carries on
+            errors.append((number, row_name, "a track called " + values[2] + " already exists"))
+    return added, errors
+
+def insert_artist(cursor, values):
+    # make sure artist does not exist in database already
+    cursor.execute("select artistID from artists where artist_name = ?", (values[0],))
+    if cursor.fetchone() is None:
+        # artist does not exist in database, so add artist to the table
+        cursor.execute('insert into Artists (artist_name, city, state) values (?, ?, ?)', values)
+    else:
+        print("Artist already exists in database")
 
+def insert_label(cursor, label_name):
+    # make sure label does not exist in database
+    cursor.execute("select record_labelID from RecordLabels where label_name = ?", (label_name,))
+    if cursor.fetchone() is None:
+        # label does not exist, so add it
+        cursor.execute('insert into RecordLabels (label_name) values (?)', (label_name,))
+    else:
+        print("Label already exists in database")
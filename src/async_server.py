@@ -0,0 +1,202 @@
+""" Asyncio front end for AlbumServer. This is an alternative to the blocking
+    HTTPServer/PooledHTTPServer in web_server.py and serves exactly the same
+    pages (albums, artists, labels, tracks, add_* forms).
+
+    Each client connection is a coroutine on the event loop, so idle keep-alive
+    connections cost very little (no thread per connection). When a complete
+    request has been read, the request is handed to the MyServer routes from
+    web_server.py, which run in a small thread pool so the event loop never
+    blocks on SQLite. The response is written back by the event loop as it
+    is produced, so big pages are still streamed (chunked) to the client.
+
+    Start with:
+        python async_server.py
+    The blocking server is still available for comparison:
+        python web_server.py
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import argparse
+import asyncio
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+import access_log
+import compression
+import query_profiler
+import web_server
+
+# hardcoded global parameters (can be overridden on the command line)
+db_threads = 4              # size of thread pool (and db connection pool) for routes
+idle_timeout = 60           # seconds to keep an idle keep-alive connection open
+max_header_size = 65536     # largest request line + headers accepted
+
+content_length_re = re.compile(rb"^content-length:\s*(\d+)\s*$", re.IGNORECASE | re.MULTILINE)
+expect_continue_re = re.compile(rb"^expect:\s*100-continue\s*$", re.IGNORECASE | re.MULTILINE)
+
+class StreamWriterFile:
+    """wfile for a request handler running in the thread pool. Each write is
+       handed to the event loop, which writes it to the client, and the
+       handler waits until the data has been taken (drain). So the page goes
+       out a chunk at a time as it is rendered, and a slow client slows the
+       rendering down instead of the response piling up in memory.
+
+       Parameters:
+       writer: the connection's asyncio.StreamWriter
+       loop: the event loop the connection belongs to
+    """
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        # raises ConnectionError if the client has gone away
+        future = asyncio.run_coroutine_threadsafe(self.send(bytes(data)), self.loop)
+        try:
+            future.result(idle_timeout)
+        except TimeoutError:
+            # client stopped reading (or the server is shutting down)
+            future.cancel()
+            raise ConnectionError(f"Response not taken for {idle_timeout} seconds")
+        return len(data)
+
+    def flush(self):
+        """every write has already been sent"""
+
+class BufferedRequest(web_server.MyServer):
+    """MyServer request handler that processes one request that has already
+       been read from the client. The response is written to the client
+       through the event loop (see StreamWriterFile).
+
+       Parameters:
+       request_bytes: request line, headers and body
+       client_address: (host, port) of the client
+       server: the asyncio server (only used for logging)
+       wfile: StreamWriterFile for the connection
+    """
+
+    def __init__(self, request_bytes, client_address, server, wfile):
+        # don't call BaseHTTPRequestHandler.__init__, it expects a socket
+        self.rfile = io.BytesIO(request_bytes)
+        self.wfile = wfile
+        self.client_address = client_address
+        self.server = server
+        self.close_connection = True
+
+    def handle_expect_100(self):
+        """the event loop has already sent "100 Continue" to the client"""
+        return True
+
+    def run(self):
+        """handle the request and return True if the connection should be closed"""
+        self.handle_one_request()
+        return self.close_connection
+
+class AsyncAlbumServer:
+    """Serve AlbumServer pages from an asyncio event loop
+
+       Parameters:
+       threads: number of threads that run the MyServer routes
+    """
+
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix="db")
+
+    def run_request(self, request_bytes, client_address, wfile):
+        """runs in the executor: route the request and send the page"""
+        return BufferedRequest(request_bytes, client_address, self, wfile).run()
+
+    async def handle_connection(self, reader, writer):
+        """read requests from one client connection until it is closed, times
+           out or asks for the connection to be closed
+        """
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info("peername")[:2]
+        wfile = StreamWriterFile(writer, loop)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+
+                # read the request body (POST) if there is one. A body sent
+                # with Transfer-Encoding instead of Content-Length isn't read:
+                # the handler refuses it with 411 and the connection is closed
+                # (see MyServer.parse_request)
+                match = content_length_re.search(head)
+                body = b""
+                if match:
+                    if expect_continue_re.search(head):
+                        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    body = await reader.readexactly(int(match.group(1)))
+
+                close = await loop.run_in_executor(
+                    self.executor, self.run_request, head + body, client_address, wfile)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection,
+                                            web_server.hostname, web_server.serverport,
+                                            limit=max_header_size, backlog=1024)
+        print(f"Async server started http://{web_server.hostname}:{web_server.serverport}")
+        async with server:
+            await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AlbumServer asyncio http server")
+    parser.add_argument("--threads", type=int, default=db_threads,
+                        help="number of threads (and database connections) that run the routes")
+    parser.add_argument("--slow-query-ms", type=float,
+                        help="profile database statements and log the ones slower than this")
+    parser.add_argument("--access-log", default=web_server.access_log_file,
+                        help="file for the access log, one JSON object per request "
+                             "(default - for stderr)")
+    parser.add_argument("--no-access-log", action="store_true", help="don't log requests")
+    args = parser.parse_args()
+
+    # the MyServer routes use the global database object in web_server
+    if args.slow_query_ms is not None:
+        web_server.profiler = query_profiler.QueryProfiler(args.slow_query_ms)
+    web_server.my_albumsdb = web_server.open_database(args.threads)
+    web_server.templates.preload()
+    if not args.no_access_log:
+        web_server.request_log = access_log.AccessLog(args.access_log)
+
+    async_server = AsyncAlbumServer(args.threads)
+    try:
+        asyncio.run(async_server.serve())
+    except KeyboardInterrupt:
+        pass
+
+    async_server.executor.shutdown(wait=True)
+    web_server.my_albumsdb.closeDB()
+    if web_server.request_log is not None:
+        web_server.request_log.close()
+    print(compression.stats.summary())
+    if web_server.profiler is not None:
+        print(web_server.profiler.report())
+    print("Http server stopped.")
@@ -0,0 +1,362 @@
+""" Load generator for AlbumServer.
+
+    Sends a weighted mix of the server's real requests (the list pages, track
+    pages, the add forms and the form POSTs) to a running server and reports
+    the throughput and latency (p50/p95/p99/max) of each route.
+
+    There are two ways to drive the server:
+
+        --concurrency N     N clients, each sending its next request as soon
+                            as it gets the last response (default)
+        --rate R            R requests per second on a fixed schedule, however
+                            slowly the server answers. Latency is measured
+                            from when each request was due, so a server that
+                            falls behind shows it in the latency figures.
+
+    Results can be saved as JSON, and two result files compared to catch
+    regressions:
+
+        python benchmark.py --duration 30 --json before.json
+        python benchmark.py --duration 30 --json after.json
+        python benchmark.py --compare before.json after.json
+
+    --compare exits with status 1 if the throughput or the p95/p99 latency
+    of any route got worse by more than --threshold percent.
+
+    NOTE: the POST requests add artists, labels, albums and tracks to the
+    database. Use --read-only to leave them out, or run against a copy of
+    the database (see generate_catalog.py for a way to make a big one).
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# hardcoded global parameters
+default_host = "localhost"
+default_port = 9000
+default_duration = 30           # seconds
+default_concurrency = 8
+default_threshold = 10          # percent, for --compare
+request_timeout = 30            # seconds
+
+# request mix: route name, weight, method, path. The fields sent by the POST
+# routes come from form_fields().
+routes = [
+    ("albums", 30, "GET", "/albums"),
+    ("tracks", 30, "GET", "/tracks?ID={album_id}"),
+    ("artists", 10, "GET", "/artists"),
+    ("labels", 10, "GET", "/labels"),
+    ("add_album form", 3, "GET", "/add_album"),
+    ("add_track form", 3, "GET", "/add_track"),
+    ("add_artist form", 2, "GET", "/add_artist"),
+    ("add_label form", 2, "GET", "/add_label"),
+    ("post artist", 1, "POST", "/add_artist"),
+    ("post label", 1, "POST", "/add_label"),
+    ("post album", 1, "POST", "/add_album"),
+    ("post track", 1, "POST", "/add_track"),
+]
+
+# names added by the POSTs have to be unique, so they include this run's id
+run_id = f"{os.getpid()}-{int(time.time())}"
+name_counter = itertools.count(1)
+
+def form_fields(route, rng, max_album_id):
+    """the form fields for a POST route, as the add forms would send them"""
+    n = next(name_counter)
+    if route == "post artist":
+        return {"artist_name": f"Bench Artist {run_id}-{n}", "city": "Chicago", "state": "IL"}
+    if route == "post label":
+        return {"label_name": f"Bench Label {run_id}-{n}"}
+    if route == "post album":
+        return {"album_title": f"Bench Album {run_id}-{n}", "artistID": "1", "year": "1999",
+                "labelID": "1", "price": "9.99"}
+    if route == "post track":
+        return {"albumID": str(rng.randint(1, max_album_id)), "track_num": "1",
+                "track_title": f"Bench Track {run_id}-{n}", "track_length": "3:30"}
+    raise ValueError("no form for route " + route)
+
+def multipart_body(fields):
+    """encode fields as multipart/form-data, like a browser submitting a form
+
+       Returns: (body, content type)
+    """
+    boundary = "----AlbumServerBenchmark" + run_id
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n')
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts).encode("utf-8"), "multipart/form-data; boundary=" + boundary
+
+class Client:
+    """One simulated browser with its own keep-alive connection
+
+       Parameters:
+       host, port: the server
+       accept_encoding: sent with every request (None to ask for uncompressed pages)
+       headers: any other headers to send with every request (eg X-Tenant)
+    """
+
+    def __init__(self, host, port, accept_encoding, headers=None):
+        self.host = host
+        self.port = port
+        self.accept_encoding = accept_encoding
+        self.headers = headers or {}
+        self.conn = None
+
+    def request(self, method, path, fields=None):
+        """send a request and read the whole response
+
+           Returns: (status, response size in bytes). status is 0 if the
+                    request failed without a response.
+        """
+        status, body = self.fetch(method, path, fields)
+        return status, len(body)
+
+    def fetch(self, method, path, fields=None):
+        """send a request and read the whole response
+
+           Returns: (status, response body). status is 0 if the request
+                    failed without a response.
+        """
+        headers = dict(self.headers)
+        if self.accept_encoding:
+            headers["Accept-Encoding"] = self.accept_encoding
+        body = None
+        if fields is not None:
+            body, headers["Content-Type"] = multipart_body(fields)
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=request_timeout)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                body = response.read()
+                if response.will_close:
+                    self.close()
+                return response.status, body
+            except (OSError, http.client.HTTPException):
+                # the server may have closed an idle keep-alive connection, so
+                # try once more on a new connection
+                self.close()
+        return 0, b""
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class Recorder:
+    """Collects (route, status, latency, size) for each request"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}           # route: list of (status, latency, size)
+
+    def record(self, route, status, latency, size):
+        with self.lock:
+            self.samples.setdefault(route, []).append((status, latency, size))
+
+def percentile(sorted_values, p):
+    """nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(recorder, elapsed, settings):
+    """Turn the recorded samples into the results dictionary (which is what
+       gets saved as JSON). Latencies are in milliseconds.
+    """
+    results = {"settings": settings, "elapsed": round(elapsed, 3), "routes": {}}
+    everything = []
+    for route, samples in sorted(recorder.samples.items()):
+        latencies = sorted(latency * 1000 for status, latency, size in samples)
+        everything.extend(latencies)
+        statuses = {}
+        for status, latency, size in samples:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        results["routes"][route] = route_stats(latencies, elapsed)
+        results["routes"][route]["errors"] = sum(1 for status, latency, size in samples
+                                                 if status == 0 or status >= 400)
+        results["routes"][route]["statuses"] = statuses
+        results["routes"][route]["bytes"] = sum(size for status, latency, size in samples)
+    results["total"] = route_stats(sorted(everything), elapsed)
+    results["total"]["errors"] = sum(route["errors"] for route in results["routes"].values())
+    return results
+
+def route_stats(latencies, elapsed):
+    return {
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50": round(percentile(latencies, 50), 3),
+        "p95": round(percentile(latencies, 95), 3),
+        "p99": round(percentile(latencies, 99), 3),
+        "max": round(latencies[-1], 3) if latencies else 0.0,
+    }
+
+def print_results(results):
+    print(f"{'route':<18}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>9}{'errors':>8}")
+    rows = list(results["routes"].items()) + [("total", results["total"])]
+    for route, stats in rows:
+        print(f"{route:<18}{stats['requests']:>9}{stats['throughput']:>9.1f}{stats['p50']:>9.2f}"
+              f"{stats['p95']:>9.2f}{stats['p99']:>9.2f}{stats['max']:>9.2f}{stats['errors']:>8}")
+
+def run(host, port, duration, concurrency, rate=None, read_only=False, max_album_id=30,
+        seed=None, accept_encoding="gzip, deflate"):
+    """Run the benchmark and return the results dictionary
+
+       Parameters:
+       host, port: the server
+       duration: seconds to run for
+       concurrency: number of clients
+       rate: requests per second on a fixed schedule, or None to send as
+             fast as the clients can
+       read_only: leave out the POST requests
+       max_album_id: /tracks and the track POSTs use album IDs 1..max_album_id
+       seed: random seed for the request mix
+    """
+    mix = [route for route in routes if not (read_only and route[2] == "POST")]
+    weights = list(itertools.accumulate(route[1] for route in mix))
+    recorder = Recorder()
+    schedule = queue.Queue() if rate else None
+    start = time.perf_counter()
+    stop_at = start + duration
+
+    def next_request(rng):
+        route, weight, method, path = rng.choices(mix, cum_weights=weights)[0]
+        path = path.format(album_id=rng.randint(1, max_album_id))
+        fields = form_fields(route, rng, max_album_id) if method == "POST" else None
+        return route, method, path, fields
+
+    def worker(number):
+        rng = random.Random(f"{seed}-{number}")
+        client = Client(host, port, accept_encoding)
+        try:
+            while True:
+                if schedule is None:
+                    if time.perf_counter() >= stop_at:
+                        break
+                    due = time.perf_counter()
+                else:
+                    due = schedule.get()
+                    if due is None:
+                        break
+                route, method, path, fields = next_request(rng)
+                status, size = client.request(method, path, fields)
+                recorder.record(route, status, time.perf_counter() - due, size)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    if schedule is not None:
+        # hand out request times on a fixed schedule. If every client is
+        # busy the requests wait in the queue, and the wait counts as latency.
+        interval = 1 / rate
+        for n in itertools.count():
+            due = start + n * interval
+            if due >= stop_at:
+                break
+            time.sleep(max(0.0, due - time.perf_counter()))
+            schedule.put(due)
+        for thread in threads:
+            schedule.put(None)
+
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    settings = {"host": host, "port": port, "duration": duration, "concurrency": concurrency,
+                "rate": rate, "read_only": read_only, "max_album_id": max_album_id,
+                "seed": seed, "accept_encoding": accept_encoding}
+    return summarize(recorder, elapsed, settings)
+
+def compare(old, new, threshold=default_threshold):
+    """Compare two results dictionaries route by route and print the changes
+
+       Returns: list of regressions (route, measure, old value, new value)
+    """
+    regressions = []
+    print(f"{'route':<18}{'req/s':>28}{'p95 ms':>28}{'p99 ms':>28}")
+    routes = [route for route in new["routes"] if route in old["routes"]] + ["total"]
+    for route in routes:
+        old_stats = old["total"] if route == "total" else old["routes"][route]
+        new_stats = new["total"] if route == "total" else new["routes"][route]
+        line = f"{route:<18}"
+        for measure, higher_is_better in (("throughput", True), ("p95", False), ("p99", False)):
+            before = old_stats[measure]
+            after = new_stats[measure]
+            change = (after - before) / before * 100 if before else 0.0
+            worse = -change if higher_is_better else change
+            flag = " "
+            if worse > threshold:
+                regressions.append((route, measure, before, after))
+                flag = "!"
+            line += f"{before:>9.2f} ->{after:>9.2f} {change:+5.0f}%{flag}"
+        print(line)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for AlbumServer")
+    parser.add_argument("--host", default=default_host)
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--duration", type=float, default=default_duration, help="seconds to run for")
+    parser.add_argument("--concurrency", type=int, default=default_concurrency,
+                        help="number of simultaneous clients")
+    parser.add_argument("--rate", type=float, help="requests per second on a fixed schedule")
+    parser.add_argument("--read-only", action="store_true", help="don't send the form POSTs")
+    parser.add_argument("--max-album-id", type=int, default=30,
+                        help="highest album ID used for /tracks (default 30)")
+    parser.add_argument("--seed", default="1", help="random seed for the request mix")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="don't send Accept-Encoding")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved result files")
+    parser.add_argument("--threshold", type=float, default=default_threshold,
+                        help="percent change counted as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.threshold)
+        for route, measure, before, after in regressions:
+            print(f"REGRESSION {route} {measure}: {before} -> {after}")
+        sys.exit(1 if regressions else 0)
+
+    mode = f"{args.rate} requests/second" if args.rate else f"{args.concurrency} clients"
+    print(f"Benchmarking http://{args.host}:{args.port} for {args.duration} seconds with {mode}...")
+    results = run(args.host, args.port, args.duration, args.concurrency, args.rate,
+                  args.read_only, args.max_album_id, args.seed,
+                  None if args.no_compression else "gzip, deflate")
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to " + args.json)
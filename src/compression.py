@@ -0,0 +1,110 @@
+""" Response compression for AlbumServer.
+
+    Picks a Content-Encoding (gzip or deflate) from the browser's
+    Accept-Encoding header and compresses page bodies. The server keeps the
+    compressed versions of each page next to the uncompressed page in the page
+    cache, so an unchanged page is only compressed once. The counters below
+    show how many bytes compression has saved.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import gzip
+import threading
+import zlib
+
+# hardcoded global parameters
+min_size = 1024             # don't compress bodies smaller than this
+compress_level = 6
+
+# encodings we can produce, in order of preference when the browser rates
+# them equally. HTTP "deflate" is really zlib format data.
+supported_encodings = ("gzip", "deflate")
+
+class CompressionStats:
+    """Counts compressed responses and the bytes compression saved"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = 0
+        self.bytes_uncompressed = 0
+        self.bytes_sent = 0
+
+    def record(self, uncompressed_size, sent_size):
+        with self.lock:
+            self.responses += 1
+            self.bytes_uncompressed += uncompressed_size
+            self.bytes_sent += sent_size
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_uncompressed - self.bytes_sent
+
+    def summary(self):
+        return (f"Compressed {self.responses} responses: {self.bytes_uncompressed} bytes "
+                f"sent as {self.bytes_sent} bytes ({self.bytes_saved} bytes saved)")
+
+stats = CompressionStats()
+
+def choose_encoding(accept_encoding, size):
+    """Return the content coding to use for a body of size bytes: "gzip",
+       "deflate" or "identity" (not compressed).
+
+       Parameters:
+       accept_encoding: the request's Accept-Encoding header (or None)
+       size: length of the uncompressed body
+    """
+    if not accept_encoding or size < min_size:
+        return "identity"
+
+    # eg "gzip, deflate;q=0.5, br" - encodings with q=0 are not acceptable
+    best = "identity"
+    best_q = 0.0
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name == "*":
+            name = supported_encodings[0]
+        if name in supported_encodings and q > 0:
+            if q > best_q or (q == best_q and
+                              supported_encodings.index(name) < supported_encodings.index(best)):
+                best = name
+                best_q = q
+    return best
+
+def compress(body, encoding):
+    """compress body (bytes) with encoding ("gzip" or "deflate")"""
+    if encoding == "gzip":
+        # mtime=0 so the same page always compresses to the same bytes
+        return gzip.compress(body, compresslevel=compress_level, mtime=0)
+    if encoding == "deflate":
+        return zlib.compress(body, compress_level)
+    raise ValueError("unsupported encoding " + encoding)
+
+def compressor(encoding):
+    """Return a zlib compress object that produces encoding ("gzip" or 
+       "deflate") a piece at a time, for pages that are streamed. Returns None
+       for "identity".
+    """
+    if encoding == "gzip":
+        return zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+    if encoding == "deflate":
+        return zlib.compressobj(compress_level, zlib.DEFLATED, 15)
+    return None
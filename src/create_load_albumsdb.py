@@ -1,206 +1,225 @@
 """Database creation/load script for AlbumServer web app
 
-    This program performs three tasks:
-       
+    This program performs four tasks:
+
        1. Check to see if database file already exists. If it does,
           prompt user to verify deletion
        2. Create a new database file and create tables in database
-       3. Load test data into database (from csv files located in datafiles 
-          directory). Loading the data takes a few minutes - be patient.
-       
-    Notes: 
-        * There is very little error checking here! 
-        * csv data can be finicky. Apostrophies in input data in the csv files 
+       3. Load test data into database (from csv files located in datafiles
+          directory). Each csv file is read a batch of rows at a time and
+          inserted with executemany, all in a single transaction per table.
+       4. Build the indexes (schema migrations, see migrations.py). Indexes
+          are built after the data is loaded, which is much faster than
+          updating them one row at a time.
+
+    The csv files are streamed, so they can be as large as you like (see
+    generate_catalog.py for a way to make large ones). The time taken and
+    rows per second are shown for each table.
+
+    Usage:
+        python create_load_albumsdb.py [--db file] [--datadir directory] [--yes]
+
+    Notes:
+        * There is very little error checking here!
+        * csv data can be finicky. Apostrophies in input data in the csv files
           may be displayed incorrectly. Replace apostrophies with single quotes.
           Commas in strings (eg "Emerson, Lake & Palmer") will cause the data to
           be broken up into separate fields. Remove commas in strings.
           Granted, this is not the best way to handle this, but this is an educational
-          tool and not production ready software. 
-    
+          tool and not production ready software.
+
     Copyright (C) August 2022  Bob Brander
- 
+
     This program is free software: you can redistribute it and/or modify
     it under the terms of the GNU General Public License as published by
-    the Free Software Foundation version 3. The full license is 
-    available here: https://opensource.org/licenses/GPL-3.0 
- 
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
     This program is distributed in the hope that it will be useful,
     but WITHOUT ANY WARRANTY; without even the implied warranty of
     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
     GNU General Public License for more details.
-"""       
+"""
 
 import sys
 import os
 import csv
+import time
+import argparse
+import itertools
 import sqlite3
 from sqlite3 import Error
+import migrations
 
 database_file = r"..\database\albums.db"
-
-# 1. Check to see if database file exists, prompt user to confirm removal
-  
-if os.path.isfile(database_file):
-    delete_database_file = input(database_file + " exists. Delete it (y/n)? ")
-    if delete_database_file.upper() == 'Y':
-        os.remove(database_file)
-        print(database_file + " removed! Continuing with database creation.")
+datafiles_dir = r"..\datafiles"
+batch_size = 10000          # rows per executemany call
+
+# csv file, table name and insert statement for each table, in load order
+# (artists and labels before the albums that refer to them)
+load_files = [
+    ("artists_initial_load.csv", "Artists",
+     "insert into Artists (artist_name, city, state) values (?, ?, ?)"),
+    ("record_labels_initial_load.csv", "Record Labels",
+     "insert into RecordLabels (label_name) values (?)"),
+    ("albums_initial_load.csv", "Albums",
+     "insert into Albums (price, album_title, artistRef, year, record_labelRef) values (?, ?, ?, ?, ?)"),
+    ("tracks_initial_load.csv", "Tracks",
+     "insert into Tracks (albumRef, tracknum, track_title, length) values (?, ?, ?, ?)"),
+]
+
+def create_tables(dbconn):
+    """Create the base tables (schema version 0). Indexes are added later by
+       migrations.apply_migrations()
+    """
+    dbconn.executescript("""
+    CREATE TABLE Artists
+    (
+    	artistID integer primary key AUTOINCREMENT,
+    	artist_name text not null unique,
+    	city text,
+        state text
+    );
+
+    CREATE TABLE RecordLabels
+    (
+    	record_labelID integer primary key AUTOINCREMENT,
+    	label_name text
+    );
+
+    CREATE TABLE Albums
+    (
+        albumID integer primary key AUTOINCREMENT,
+        price real,
+    	album_title text not null unique,
+    	artistRef integer not null,
+    	year integer not null,
+    	record_labelRef integer not null,
+    	FOREIGN KEY (artistRef) REFERENCES Artists (artistID),
+    	FOREIGN KEY (record_labelRef) REFERENCES RecordLabels (record_labelID)
+    );
+
+    CREATE TABLE Tracks
+    (
+    	trackID integer primary key AUTOINCREMENT,
+    	albumRef integer not null,
+    	tracknum integer not null,
+    	track_title text not null unique,
+    	length real,
+    	FOREIGN KEY (albumRef) REFERENCES Albums (albumID)
+    );
+    """)
+    dbconn.commit()
+
+def prepare_for_load(dbconn):
+    """Settings for a fast bulk load into a brand new database. If the load
+       is interrupted the database may be corrupt, but it is a new database
+       that would be re-created anyway.
+    """
+    dbconn.execute("PRAGMA journal_mode = OFF")
+    dbconn.execute("PRAGMA synchronous = OFF")
+    dbconn.execute("PRAGMA cache_size = -262144")       # 256MB
+    dbconn.execute("PRAGMA temp_store = MEMORY")
+
+def finish_load(dbconn):
+    """Build the indexes (and the rest of the schema migrations) now the
+       data is in, then put the normal safe settings back
+    """
+    start = time.perf_counter()
+    migrations.apply_migrations(dbconn, verbose=True)
+    print(f"Built indexes in {time.perf_counter() - start:.2f} seconds")
+    dbconn.execute("PRAGMA journal_mode = DELETE")
+    dbconn.execute("PRAGMA synchronous = FULL")
+
+def load_rows(dbconn, table_name, insert_sql, rows, batch_size=batch_size):
+    """Insert rows (any iterable of tuples) into a table in batches of
+       batch_size, all in a single transaction, and print how long it took.
+
+       Returns: number of rows inserted
+    """
+    start = time.perf_counter()
+    row_count = 0
+    rows = iter(rows)
+    with dbconn:            # one transaction, committed at the end
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            dbconn.executemany(insert_sql, batch)
+            row_count += len(batch)
+    elapsed = time.perf_counter() - start
+    rate = row_count / elapsed if elapsed > 0 else 0
+    print(f"Inserted {row_count} {table_name} in {elapsed:.2f} seconds ({rate:,.0f} rows/second)")
+    return row_count
+
+def load_csv(dbconn, table_name, csv_file_name, insert_sql, batch_size=batch_size):
+    """Stream a csv file (first line is a header) into a table"""
+    # make sure file exists and is readable
+    if not os.access(csv_file_name, os.R_OK):
+        sys.exit("Input csv file " + csv_file_name + " not found. Program exiting.")
+
+    # only the first column_count fields of each line are used (some lines
+    # have a stray trailing field), and blank lines are skipped
+    column_count = insert_sql.count("?")
+    with open(csv_file_name, newline="") as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        next(csv_reader, None)          # skip header
+        rows = (row[:column_count] for row in csv_reader if row)
+        return load_rows(dbconn, table_name, insert_sql, rows, batch_size)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the AlbumServer database and load test data")
+    parser.add_argument("--db", default=database_file, help="database file to create")
+    parser.add_argument("--datadir", default=datafiles_dir, help="directory with the csv files")
+    parser.add_argument("--batch-size", type=int, default=batch_size, help="rows per insert batch")
+    parser.add_argument("--yes", action="store_true", help="delete an existing database without asking")
+    args = parser.parse_args()
+    database_file = args.db
+
+    # 1. Check to see if database file exists, prompt user to confirm removal
+
+    if os.path.isfile(database_file):
+        if args.yes:
+            delete_database_file = 'Y'
+        else:
+            delete_database_file = input(database_file + " exists. Delete it (y/n)? ")
+        if delete_database_file.upper() == 'Y':
+            os.remove(database_file)
+            print(database_file + " removed! Continuing with database creation.")
+        else:
+            # this line throws an exception for some reason, but still runs correctly
+            sys.exit(database_file + " not removed. Exiting without further action." )
     else:
-        # this line throws an exception for some reason, but still runs correctly
-        sys.exit(database_file + " not removed. Exiting without further action." )
-else:
-    print(database_file + " not found. It will be created now.")
-
-# 2. Create new database_file and create tables
-
-print("Creating database and tables...")
-
-dbconn = None
-try:
-    dbconn = sqlite3.connect(database_file)
-    dbcursor = dbconn.cursor()
-except Error as e:
-    print(e)
-    sys.exit("Unable to create new database file " + database_file + ". Program exiting.")
-
-dbcursor.execute("""
-CREATE TABLE Artists
-(
-	artistID integer primary key AUTOINCREMENT,
-	artist_name text not null unique,
-	city text,
-    state text
-);
-""")
-
-dbcursor.execute("""
-CREATE TABLE RecordLabels
-(
-	record_labelID integer primary key AUTOINCREMENT,
-	label_name text
-);
-""")
-
-dbcursor.execute("""
-CREATE TABLE Albums
-(
-    albumID integer primary key AUTOINCREMENT,
-    price real,
-	album_title text not null unique,
-	artistRef integer not null,
-	year integer not null,
-	record_labelRef integer not null,
-	FOREIGN KEY (artistRef) REFERENCES Artists (artistID),
-	FOREIGN KEY (record_labelRef) REFERENCES RecordLabels (record_labelID)
-);
-""")
-
-dbcursor.execute("""
-CREATE TABLE Tracks
-(
-	trackID integer primary key AUTOINCREMENT,
-	albumRef integer not null,
-	tracknum integer not null,
-	track_title text not null unique,
-	length real,
-	FOREIGN KEY (albumRef) REFERENCES Albums (albumID)
-);
-""")
-
-dbconn.commit()
-
-# 3. Load test data into new database
-
-print("Loading test data into new database. This may take a few minutes...")
-
-artists_file = r'..\datafiles\artists_initial_load.csv'
-
-# make sure artists file exists and is readable
-if not os.access(artists_file, os.R_OK):
-            sys.exit("Input csv file " + artists_file + " not found. Program exiting.")
-            
-# load data from artists csv file into database
-with open(artists_file) as artists_csv_file:
-    artists_csv_reader = csv.reader(artists_csv_file, delimiter=',')
-    line_count = 0
-    for artist in artists_csv_reader:
-        if line_count == 0:
-            line_count += 1
-        else:  
-            dbcursor.execute('insert into Artists (artist_name, city, state) values (?, ?, ?)', (artist[0], artist[1], artist[2]))
-            dbconn.commit()
-            
-            line_count += 1
-    print("Inserted " + str(line_count-1) + " Aritsts")
-artists_csv_file.close()
-
-labels_file = r'..\datafiles\record_labels_initial_load.csv'
-
-# make sure record labels file exists and is readable
-if not os.access(labels_file, os.R_OK):
-            sys.exit("Input csv file " + labels_file + " not found. Program exiting.")
-            
-# load data from labels csv file into database
-with open(labels_file) as labels_csv_file:
-    labels_csv_reader = csv.reader(labels_csv_file, delimiter=',')
-    line_count = 0
-    for label in labels_csv_reader:
-        if line_count == 0:
-            line_count += 1
-        else:  
-            dbcursor.execute('insert into RecordLabels (label_name) values (?)', (label[0],))
-            dbconn.commit()
-            
-            line_count += 1
-    print("Inserted " + str(line_count-1) + " Record Labels")
-labels_csv_file.close()
-
-albums_file = r'..\datafiles\albums_initial_load.csv'
-
-# make sure albums file exists and is readable
-if not os.access(albums_file, os.R_OK):
-            sys.exit("Input csv file " + albums_file + " not found. Program exiting.")
-            
-# load data from albums csv file into database
-with open(albums_file) as albums_csv_file:
-    albums_csv_reader = csv.reader(albums_csv_file, delimiter=',')
-    line_count = 0
-    for album in albums_csv_reader:
-        if line_count == 0:
-            line_count += 1
-        else:  
-            dbcursor.execute('insert into Albums (price, album_title, artistRef, year, record_labelRef) values (?, ?, ?, ?, ?)', \
-             (album[0], album[1], album[2], album[3], album[4]))
-            dbconn.commit()
-            
-            line_count += 1
-    print("Inserted " + str(line_count-1) + " Albums")
-albums_csv_file.close()
-
-tracks_file = r'..\datafiles\tracks_initial_load.csv'
-
-# make sure tracks file exists and is readable
-if not os.access(tracks_file, os.R_OK):
-            sys.exit("Input csv file " + tracks_file + " not found. Program exiting.")
-            
-# load data from tracks csv file into database
-with open(tracks_file) as tracks_csv_file:
-    tracks_csv_reader = csv.reader(tracks_csv_file, delimiter=',')
-    line_count = 0
-    for track in tracks_csv_reader:
-        if line_count == 0:
-            line_count += 1
-        else:  
-            dbcursor.execute('insert into Tracks (albumRef, tracknum, track_title, length) values (?, ?, ?, ?)', \
-             (track[0], track[1], track[2], track[3]))
-            dbconn.commit()
-            
-            line_count += 1
-    print("Inserted " + str(line_count-1) + " Tracks")
-tracks_csv_file.close()
-
-# tidy up
-
-print("Process complete! New database created and test data loaded.")
-dbcursor.close()
-dbconn.close()
+        print(database_file + " not found. It will be created now.")
+
+    # 2. Create new database_file and create tables
+
+    print("Creating database and tables...")
+
+    dbconn = None
+    try:
+        dbconn = sqlite3.connect(database_file)
+    except Error as e:
+        print(e)
+        sys.exit("Unable to create new database file " + database_file + ". Program exiting.")
+
+    create_tables(dbconn)
+
+    # 3. Load test data into new database
+
+    print("Loading test data into new database...")
+    start = time.perf_counter()
+    prepare_for_load(dbconn)
+
+    for file_name, table_name, insert_sql in load_files:
+        load_csv(dbconn, table_name, os.path.join(args.datadir, file_name), insert_sql, args.batch_size)
+
+    # 4. Build indexes
+
+    finish_load(dbconn)
+
+    # tidy up
+
+    print(f"Process complete! New database created and test data loaded in "
+          f"{time.perf_counter() - start:.2f} seconds.")
+    dbconn.close()
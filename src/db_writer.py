@@ -0,0 +1,173 @@
+""" Single writer thread for the AlbumServer database.
+
+    SQLite only lets one connection write at a time. If every worker thread
+    committed its own writes, concurrent form submissions would queue up on
+    the database lock (and each one would wait for its own disk sync). With
+    the database in WAL mode readers don't block on the writer, so instead
+    every write is handed to one writer thread, which has the only
+    connection that writes.
+
+    The writer takes all of the writes that are waiting in its queue and runs
+    them in one transaction (group commit), so a burst of submissions costs
+    one commit instead of one each. Each write runs inside its own savepoint,
+    so a write that fails (eg a duplicate title) is rolled back on its own
+    and the rest of the group is still committed. Every caller gets its own
+    result or exception back.
+
+    Some jobs (eg restoring a snapshot with the backup API) can't run inside
+    a transaction. call() runs them on their own, between groups.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+
+# hardcoded global parameters
+max_group_size = 100        # most writes committed in one transaction
+
+class DatabaseWriter:
+    """Runs write functions on one connection in a background thread
+
+       Parameters:
+       conn: sqlite3 connection used only by the writer thread
+       on_commit: called (in the writer thread) after a transaction that
+                  changed something has been committed
+       stamp: called with a cursor at the end of every transaction that
+              changes something, before it is committed, and after every
+              call() job (eg to record a new data version)
+    """
+
+    def __init__(self, conn, on_commit=None, stamp=None):
+        self.conn = conn
+        self.conn.isolation_level = None         # we issue BEGIN/COMMIT ourselves
+        self.on_commit = on_commit
+        self.stamp = stamp
+        self.jobs = queue.Queue()
+        self.groups = 0                         # transactions committed
+        self.writes = 0                         # writes in them
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        """Queue function(cursor, *args) to run in the writer thread
+
+           Returns: a concurrent.futures.Future for function's return value
+        """
+        future = Future()
+        self.jobs.put((function, args, future, False))
+        return future
+
+    def write(self, function, *args):
+        """Run function(cursor, *args) in the writer thread and wait until it
+           has been committed. Returns its result or raises its exception.
+        """
+        return self.submit(function, *args).result()
+
+    def call(self, function, *args):
+        """Run function(conn, *args) in the writer thread on its own, outside
+           of any transaction, and wait for it. Returns its result or raises
+           its exception.
+        """
+        future = Future()
+        self.jobs.put((function, args, future, True))
+        return future.result()
+
+    def close(self):
+        """finish the writes already queued, then stop the writer thread"""
+        self.jobs.put(None)
+        self.thread.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if job[3]:
+                self.run_alone(job)
+                continue
+            group = [job]
+            alone = None
+            # everything else already waiting goes in the same transaction
+            while len(group) < max_group_size:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                if job[3]:
+                    alone = job
+                    break
+                group.append(job)
+            self.commit_group(group)
+            if alone is not None:
+                self.run_alone(alone)
+        self.conn.close()
+
+    def run_alone(self, job):
+        """run a call() job"""
+        function, args, future, alone = job
+        try:
+            result = function(self.conn, *args)
+            if self.stamp is not None:
+                self.stamp(self.conn.cursor())
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if self.on_commit is not None:
+            self.on_commit()
+        future.set_result(result)
+
+    def commit_group(self, group):
+        """run a group of writes in one transaction, each in a savepoint"""
+        outcomes = []           # (future, succeeded, result or exception)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for function, args, future, alone in group:
+                cursor.execute("SAVEPOINT write")
+                try:
+                    result = function(cursor, *args)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write")
+                    cursor.execute("RELEASE write")
+                    outcomes.append((future, False, e))
+                else:
+                    cursor.execute("RELEASE write")
+                    outcomes.append((future, True, result))
+            if self.stamp is not None and any(succeeded for future, succeeded, result in outcomes):
+                self.stamp(cursor)
+            cursor.execute("COMMIT")
+        except Exception as e:
+            # BEGIN or COMMIT failed, so nothing in the group was written
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            for function, args, future, alone in group:
+                future.set_exception(e)
+            return
+        finally:
+            cursor.close()
+
+        self.groups += 1
+        self.writes += len(group)
+        if self.on_commit is not None and any(succeeded for future, succeeded, result in outcomes):
+            self.on_commit()
+        for future, succeeded, result in outcomes:
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
@@ -0,0 +1,281 @@
+""" Test catalog generator for AlbumServer.
+
+    The csv files in the datafiles directory only have a few dozen albums,
+    which is far too small to show how the server behaves with a real sized
+    catalog. This program makes a catalog of any size, from a thousand to
+    ten million tracks, in the same csv format (or straight into a new
+    database).
+
+    The catalog is made from a seed, so the same seed and size always give
+    exactly the same catalog. Every benchmark run can use the same data.
+
+    The numbers are skewed the way a real catalog is: a few artists have lots
+    of albums and most have one or two, most albums have 8 to 14 tracks but
+    there are singles, EPs and long double albums, and the big labels put
+    out most of the albums. Track lengths are mostly m:ss with some decimal
+    minutes (eg 4.52), like the lengths people type into the add track form.
+
+    Usage:
+        python generate_catalog.py --tracks 1000000 --out-dir big_catalog
+        python generate_catalog.py --tracks 1000000 --db big_catalog.db
+
+    To load generated csv files use create_load_albumsdb.py --datadir
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import argparse
+import csv
+import itertools
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+import create_load_albumsdb as loader
+
+# hardcoded global parameters
+default_seed = 42
+default_tracks = 100000
+min_tracks = 10 ** 3
+max_tracks = 10 ** 7
+artist_skew = 0.75         # zipf exponent for albums per artist
+label_skew = 1.0            # zipf exponent for albums per label
+decimal_lengths = 0.15      # fraction of track lengths written as decimal minutes
+
+# Words used to make names. Names are built so that every name is different
+# (the name columns are unique), see unique_name(). The lists must not share
+# words with the name prefixes below.
+words = """
+    Absent Acid Afternoon Alibi Amber Angel Anthem April Arrow Ash Atlas August
+    Autumn Avenue Bad Ballad Banner Bay Beach Bell Big Bitter Black Blind Blood
+    Blue Bone Border Bound Brass Bridge Bright Broken Brother Brown Burning
+    Cactus Canyon Carnival Castle Chain Chance Cherry Circle City Clear Cloud
+    Coast Cold Copper Coyote Crazy Crimson Crystal Cry Dance Dark Dawn Daylight
+    Deep Desert Devil Diamond Dirty Distant Dream Drift Driving Dust Eagle Early
+    Echo Electric Ember Empty Endless Evening Fading Faith Falling Far Fever
+    Fire First Flame Flower Forever Free Frozen Garden Ghost Glass Gold Golden
+    Gravity Green Grey Gypsy Harbor Heart Heaven Highway Hollow Home Honey Horizon
+    Hungry Ice Iron Island Jade Jungle Kingdom Lady Last Late Lazy Light Lightning
+    Little Lonely Long Lost Love Lucky Magic Make Mercy Midnight Mirror Moon
+    Morning Mountain Neon Never New Night Noble Northern Ocean Old Open Orange
+    Outlaw Paper Paradise Party Pearl Picture Pilgrim Pink Pocket Prairie Prayer
+    Purple Queen Quiet Radio Rain Rainbow Red Restless Ride River Road Rock Rolling
+    Rose Running Rust Sad Saint Salt Satellite Savage Secret Shadow Shine Silent
+    Silver Simple Sister Sky Slow Smoke Snow Soul Southern Spark Spirit Spring
+    Star Steel Stone Storm Strange Street Summer Sun Sunday Sweet Tender Thunder
+    Tiger Time Tonight Train True Tunnel Twilight Velvet Violet Voice Wander
+    Warm Water Wave Western Whiskey White Wild Wind Winter Wire Wolf Wonder Yellow
+    Young
+""".split()
+
+artist_prefixes = ["The"]
+label_suffixes = ["Records", "Music", "Recordings", "Sound"]
+
+places = [
+    ("Los Angeles", "CA"), ("San Francisco", "CA"), ("New York", "NY"), ("Nashville", "TN"),
+    ("Chicago", "IL"), ("Austin", "TX"), ("Seattle", "WA"), ("Detroit", "MI"),
+    ("Memphis", "TN"), ("Atlanta", "GA"), ("Boston", "MA"), ("Minneapolis", "MN"),
+    ("London", "UK"), ("Manchester", "UK"), ("Liverpool", "UK"), ("Toronto", "ON"),
+]
+
+# tracks per album: (number of tracks, relative weight). Mostly 8-14, with
+# singles, EPs and long albums
+album_sizes = ([(1, 3), (2, 4), (4, 4), (5, 5), (6, 4)] +
+               [(size, 12) for size in range(8, 15)] +
+               [(size, 3) for size in range(15, 21)] +
+               [(24, 2), (30, 1), (40, 1)])
+
+def name_width(count):
+    """number of words needed to give count different names"""
+    return max(2, math.ceil(math.log(count + 1, len(words))))
+
+def unique_name(index, width, spread):
+    """Turn index into width words. Different indexes always give different
+       names. Multiplying by spread (which must have no factors in common with
+       the number of possible names) mixes the names up, so consecutive rows
+       don't all start with the same word.
+    """
+    n = ((index + 1) * spread) % (len(words) ** width)
+    name = []
+    for _ in range(width):
+        n, digit = divmod(n, len(words))
+        name.append(words[digit])
+    return " ".join(name)
+
+def spread_for(rng, width):
+    """a random multiplier for unique_name() with no factors in common with
+       len(words) ** width
+    """
+    total = len(words) ** width
+    while True:
+        spread = rng.randrange(total // 3, total)
+        if math.gcd(spread, total) == 1:
+            return spread
+
+def zipf_weights(count, skew):
+    """cumulative weights for picking 1..count with probability
+       proportional to 1 / rank ** skew
+    """
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+class Catalog:
+    """A generated catalog. Each table has its own random number generator
+       (seeded from the catalog seed), so each table can be produced on its
+       own, and produces the same rows every time.
+
+       Parameters:
+       tracks: approximate number of tracks
+       seed: anything random.Random() accepts as a seed
+    """
+
+    def __init__(self, tracks=default_tracks, seed=default_seed):
+        self.seed = seed
+        # the number of tracks on each album decides how many albums there
+        # are, everything else is sized from the number of albums
+        rng = self.random("sizes")
+        sizes, weights = zip(*album_sizes)
+        self.album_sizes = []
+        total = 0
+        while total < tracks:
+            size = min(rng.choices(sizes, weights)[0], tracks - total)
+            self.album_sizes.append(size)
+            total += size
+        self.track_count = total
+        self.album_count = len(self.album_sizes)
+        self.artist_count = max(1, self.album_count // 4)
+        self.label_count = max(5, min(5000, self.album_count // 40))
+
+    def random(self, table):
+        return random.Random(f"{self.seed}-{table}")
+
+    def artists(self):
+        """yield (artist_name, city, state)"""
+        rng = self.random("artists")
+        width = name_width(self.artist_count)
+        spread = spread_for(rng, width)
+        for i in range(self.artist_count):
+            name = unique_name(i, width, spread)
+            if rng.random() < 0.2:
+                name = rng.choice(artist_prefixes) + " " + name
+            city, state = rng.choice(places)
+            yield (name, city, state)
+
+    def labels(self):
+        """yield (label_name,)"""
+        rng = self.random("labels")
+        width = name_width(self.label_count)
+        spread = spread_for(rng, width)
+        for i in range(self.label_count):
+            yield (unique_name(i, width, spread) + " " + rng.choice(label_suffixes),)
+
+    def albums(self):
+        """yield (price, album_title, artistRef, year, record_labelRef)"""
+        rng = self.random("albums")
+        width = name_width(self.album_count)
+        spread = spread_for(rng, width)
+        # shuffle which ids get the big weights, so the busiest artist isn't
+        # always artist 1
+        artist_ids = list(range(1, self.artist_count + 1))
+        rng.shuffle(artist_ids)
+        label_ids = list(range(1, self.label_count + 1))
+        rng.shuffle(label_ids)
+        artist_weights = zipf_weights(self.artist_count, artist_skew)
+        label_weights = zipf_weights(self.label_count, label_skew)
+        for i in range(self.album_count):
+            price = round(rng.uniform(7.99, 24.99), 2)
+            year = min(2022, int(rng.triangular(1955, 2022, 1995)))
+            if i < self.artist_count:
+                artist = i + 1          # every artist has at least one album
+            else:
+                artist = rng.choices(artist_ids, cum_weights=artist_weights)[0]
+            label = rng.choices(label_ids, cum_weights=label_weights)[0]
+            yield (price, unique_name(i, width, spread), artist, year, label)
+
+    def tracks(self):
+        """yield (albumRef, tracknum, track_title, length)"""
+        rng = self.random("tracks")
+        width = name_width(self.track_count)
+        spread = spread_for(rng, width)
+        i = 0
+        for album_id, size in enumerate(self.album_sizes, start=1):
+            for track_num in range(1, size + 1):
+                seconds = int(min(1500, max(60, rng.lognormvariate(5.45, 0.35))))
+                if rng.random() < decimal_lengths:
+                    length = f"{seconds / 60:.2f}"
+                else:
+                    length = f"{seconds // 60}:{seconds % 60:02d}"
+                yield (album_id, track_num, unique_name(i, width, spread), length)
+                i += 1
+
+    def tables(self):
+        """(csv file name, csv header, rows, table name, insert statement) for
+           each table, in load order
+        """
+        headers = {
+            "artists_initial_load.csv": ["artist", "city", "state"],
+            "record_labels_initial_load.csv": ["record_label"],
+            "albums_initial_load.csv": ["price", "album title", "artistRef", "year", "record_labelRef"],
+            "tracks_initial_load.csv": ["albumRef", "Track num", "track title", "length"],
+        }
+        rows = [self.artists, self.labels, self.albums, self.tracks]
+        return [(file_name, headers[file_name], table_rows(), table_name, insert_sql)
+                for (file_name, table_name, insert_sql), table_rows in zip(loader.load_files, rows)]
+
+def write_csv(catalog, out_dir):
+    """write the catalog as csv files in the datafiles format"""
+    os.makedirs(out_dir, exist_ok=True)
+    for file_name, header, rows, table_name, insert_sql in catalog.tables():
+        start = time.perf_counter()
+        with open(os.path.join(out_dir, file_name), "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(header)
+            writer.writerows(rows)
+        print(f"Wrote {file_name} in {time.perf_counter() - start:.2f} seconds")
+
+def write_database(catalog, database_file):
+    """create a new database (which must not already exist) and load the
+       catalog into it
+    """
+    dbconn = sqlite3.connect(database_file)
+    loader.create_tables(dbconn)
+    loader.prepare_for_load(dbconn)
+    for file_name, header, rows, table_name, insert_sql in catalog.tables():
+        loader.load_rows(dbconn, table_name, insert_sql, rows)
+    loader.finish_load(dbconn)
+    dbconn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a test catalog for AlbumServer")
+    parser.add_argument("--tracks", type=int, default=default_tracks,
+                        help=f"number of tracks ({min_tracks} to {max_tracks})")
+    parser.add_argument("--seed", default=default_seed, help="random seed")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--out-dir", help="directory to write csv files to")
+    output.add_argument("--db", help="new database file to create")
+    args = parser.parse_args()
+
+    if not min_tracks <= args.tracks <= max_tracks:
+        sys.exit(f"--tracks must be between {min_tracks} and {max_tracks}")
+    if args.db and os.path.exists(args.db):
+        sys.exit(args.db + " already exists. Delete it first.")
+
+    catalog = Catalog(args.tracks, args.seed)
+    print(f"Catalog: {catalog.artist_count} artists, {catalog.label_count} labels, "
+          f"{catalog.album_count} albums, {catalog.track_count} tracks (seed {args.seed})")
+
+    if args.out_dir:
+        write_csv(catalog, args.out_dir)
+    else:
+        write_database(catalog, args.db)
@@ -0,0 +1,267 @@
+""" Request and database metrics for AlbumServer.
+
+    Counts requests (by route and status code), response bytes, and how long
+    each request and each albumsDB method takes. The server publishes them
+    at /metrics in the Prometheus text format, so any Prometheus compatible
+    tool can collect them.
+
+    Recording has to be cheap, because it happens on every request. Each
+    thread records into its own shard (a plain dictionary only that thread
+    writes to), so recording never waits for a lock. The shards are only
+    added up when /metrics is read.
+
+    In prefork mode each worker process has its own metrics, and /metrics
+    shows the metrics of whichever process answered the request.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import abc
+import bisect
+import functools
+import inspect
+import threading
+import time
+from urllib.parse import urlsplit
+
+# histogram buckets (upper bounds, in seconds)
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# routes reported by name. Anything else is reported as "other", so a
+# client asking for random URLs can't create an unlimited number of series.
+known_routes = {"/", "/albums", "/artists", "/labels", "/tracks", "/search", "/add_album",
+                "/add_artist", "/add_track", "/add_tracks", "/add_label", "/metrics",
+                "/query_report", "/admin/reset"}
+
+class Metric(abc.ABC):
+    """Base class for a metric with per-thread shards. Subclasses provide
+       collect().
+
+       Parameters:
+       name: metric name
+       help: one line description
+       label_names: names of the labels, in the order values are passed
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+
+    def shard(self):
+        """this thread's shard, created the first time the thread records"""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.shards_lock:
+                self.shards.append(shard)
+            return shard
+
+    def labels_text(self, labels, extra=""):
+        pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.label_names, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abc.abstractmethod
+    def collect(self):
+        """the shards added up: dictionary of labels: value"""
+
+    def render(self):
+        """the metric in Prometheus text format (list of lines)"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{self.labels_text(labels)} {value}")
+        return lines
+
+class Counter(Metric):
+    """A count that only goes up"""
+
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self):
+        totals = {}
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard in shards:
+            # copy() is atomic, so the owner thread can keep recording
+            for labels, value in shard.copy().items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+class Histogram(Metric):
+    """Counts of observed values (eg latencies) in buckets, plus their sum
+
+       Parameters:
+       buckets: upper bounds of the buckets, in increasing order
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=latency_buckets):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # a count for each bucket, one for +Inf, then the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        totals = {}
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for labels, counts in shard.copy().items():
+                total = totals.setdefault(labels, [0] * len(counts))
+                for i, count in enumerate(list(counts)):
+                    total[i] += count
+        return totals
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                le = 'le="' + str(bound) + '"'
+                lines.append(f"{self.name}_bucket{self.labels_text(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self.labels_text(labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self.labels_text(labels)} {cumulative}")
+        return lines
+
+class Callback(Metric):
+    """A metric whose value is read from somewhere else when /metrics is
+       read (eg the page cache's hit count)
+
+       Parameters:
+       type: "counter" or "gauge"
+       function: returns the current value
+    """
+
+    def __init__(self, name, help, type, function):
+        super().__init__(name, help)
+        self.type = type
+        self.function = function
+
+    def collect(self):
+        return {(): self.function()}
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Registry:
+    """All the metrics shown at /metrics"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """every metric in Prometheus text format (str)"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+http_requests = registry.add(Counter(
+    "albumserver_http_requests_total", "HTTP requests handled",
+    ("method", "route", "status")))
+http_request_seconds = registry.add(Histogram(
+    "albumserver_http_request_duration_seconds", "Time taken to handle a request",
+    ("method", "route")))
+http_response_bytes = registry.add(Counter(
+    "albumserver_http_response_bytes_total", "Response body bytes sent",
+    ("method", "route")))
+db_call_seconds = registry.add(Histogram(
+    "albumserver_db_call_duration_seconds", "Time spent in each albumsDB method",
+    ("method",)))
+db_errors = registry.add(Counter(
+    "albumserver_db_errors_total", "albumsDB calls that raised an exception",
+    ("method",)))
+
+def route_name(path):
+    """the route label for a request path (query string removed)"""
+    route = urlsplit(path).path
+    return route if route in known_routes else "other"
+
+def record_request(method, path, status, seconds, response_bytes):
+    """record one handled request"""
+    route = route_name(path)
+    http_requests.inc(method, route, str(status))
+    http_request_seconds.observe(seconds, method, route)
+    if response_bytes:
+        http_response_bytes.inc(method, route, amount=response_bytes)
+
+def timed_generator(generator, name):
+    """pass generator's items through, adding up only the time spent
+       producing them (not the time the caller spends using them)
+    """
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                break
+            except Exception:
+                db_errors.inc(name)
+                raise
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        generator.close()
+        db_call_seconds.observe(elapsed, name)
+
+def timed(method):
+    """Decorator for albumsDB methods: records how long each call takes.
+       Methods that return a generator (the iter_* methods) are timed until
+       the generator is finished.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            db_errors.inc(name)
+            db_call_seconds.observe(time.perf_counter() - start, name)
+            raise
+        if inspect.isgenerator(result):
+            return timed_generator(result, name)
+        db_call_seconds.observe(time.perf_counter() - start, name)
+        return result
+    return wrapper
@@ -0,0 +1,338 @@
+r""" Versioned schema migrations for the AlbumServer database.
+
+    create_load_albumsdb.py creates the base tables (schema version 0). Every
+    change to the schema after that is a migration in the list below. The
+    database's schema version is kept in PRAGMA user_version, and
+    apply_migrations() runs any migrations the database hasn't had yet.
+    albumsDB.connect() calls it, so the server always runs against an up to
+    date schema. To change the schema, add a new migration to the end of the
+    list - never edit one that has already been released.
+
+    This file can also be run on its own to migrate a database and check
+    that the server's queries use indexes:
+
+        python migrations.py                 migrate ..\database\albums.db
+        python migrations.py --check         also show query plans, exit 1 if
+                                             a query scans a whole table
+        python migrations.py --check-listing check AlbumListing against the
+                                             tables it is built from
+        python migrations.py --rebuild-listing  rebuild AlbumListing
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import argparse
+import sqlite3
+import sys
+import time
+import albumsdb
+
+# The album listing as a join of the base tables. AlbumListing (migration 3)
+# holds the same rows, kept up to date by triggers, so the albums page reads
+# one table instead of joining three.
+album_listing_columns = ("albumID, album_title, artistID, artist_name, year, "
+                         "record_labelID, label_name, price")
+album_listing_join = """
+    select Albums.albumID, album_title, Artists.artistID, artist_name, year,
+           RecordLabels.record_labelID, label_name, price
+    from Albums
+    join Artists on Albums.artistRef = Artists.artistID
+    join RecordLabels on Albums.record_labelRef = RecordLabels.record_labelID"""
+
+# DataVersion (migration 4) holds a random token that every write replaces,
+# and when it was replaced (seconds since 1970), so every process can tell
+# which version of the data it is serving
+new_data_token = "lower(hex(randomblob(12)))"
+data_time_now = "(julianday('now') - 2440587.5) * 86400.0"
+stamp_data_version_sql = f"update DataVersion set token = {new_data_token}, changed_time = {data_time_now}"
+
+# (version, description, list of sql statements)
+migrations = [
+    (1, "indexes for the server's queries, unique record label names", [
+        # get_tracks: "where albumRef = ? order by tracknum" answered from the index
+        "create index if not exists Tracks_album on Tracks (albumRef, tracknum, track_title, length)",
+        # albums by artist/label, and the joins from Artists/RecordLabels to Albums
+        "create index if not exists Albums_artist on Albums (artistRef)",
+        "create index if not exists Albums_label on Albums (record_labelRef)",
+        # keyset paging of albums sorted by year or price (title is already unique)
+        "create index if not exists Albums_year on Albums (year, albumID)",
+        "create index if not exists Albums_price on Albums (price, albumID)",
+        # label names were never checked for duplicates by the loader. Point
+        # albums at the first copy of each label and drop the other copies
+        # before adding the unique index. The copies are found once, into a
+        # table keyed by ID, so each album is a single lookup.
+        """create temp table label_copies (record_labelID integer primary key, first_labelID integer)""",
+        """insert into label_copies
+               select record_labelID, first_labelID from
+                   (select record_labelID,
+                           min(record_labelID) over (partition by label_name) as first_labelID
+                    from RecordLabels)
+               where record_labelID <> first_labelID""",
+        """update Albums set record_labelRef =
+               (select first_labelID from label_copies where record_labelID = Albums.record_labelRef)
+           where record_labelRef in (select record_labelID from label_copies)""",
+        "delete from RecordLabels where record_labelID in (select record_labelID from label_copies)",
+        "drop table label_copies",
+        "create unique index if not exists RecordLabels_name on RecordLabels (label_name)",
+        # table statistics, so the planner knows it can read albums in artist 
+        # name order by walking Artists by name rather than sorting every album
+        "analyze",
+    ]),
+    (2, "full text search over album, artist, label and track names", [
+        # One FTS5 table for everything. The rowid says what each row is:
+        # rowid = ID * 4 + kind (see search_kinds). prefix indexes make
+        # prefix (type-ahead) searches fast.
+        """create virtual table if not exists CatalogSearch using fts5(
+               title, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+        "insert into CatalogSearch (rowid, title) select albumID * 4, album_title from Albums",
+        "insert into CatalogSearch (rowid, title) select artistID * 4 + 1, artist_name from Artists",
+        "insert into CatalogSearch (rowid, title) select record_labelID * 4 + 2, label_name from RecordLabels",
+        "insert into CatalogSearch (rowid, title) select trackID * 4 + 3, track_title from Tracks",
+    ] + [
+        # keep CatalogSearch in step with the base tables
+        statement
+        for table, id_column, title_column, kind in (("Albums", "albumID", "album_title", 0),
+                                                     ("Artists", "artistID", "artist_name", 1),
+                                                     ("RecordLabels", "record_labelID", "label_name", 2),
+                                                     ("Tracks", "trackID", "track_title", 3))
+        for statement in (
+            f"""create trigger if not exists {table}_search_insert after insert on {table} begin
+                    insert into CatalogSearch (rowid, title) values (new.{id_column} * 4 + {kind}, new.{title_column});
+                end""",
+            f"""create trigger if not exists {table}_search_update after update of {title_column} on {table} begin
+                    delete from CatalogSearch where rowid = old.{id_column} * 4 + {kind};
+                    insert into CatalogSearch (rowid, title) values (new.{id_column} * 4 + {kind}, new.{title_column});
+                end""",
+            f"""create trigger if not exists {table}_search_delete after delete on {table} begin
+                    delete from CatalogSearch where rowid = old.{id_column} * 4 + {kind};
+                end""",
+        )
+    ]),
+    (3, "AlbumListing: the albums joined with their artist and label, kept up to date by triggers", [
+        """create table if not exists AlbumListing (
+               albumID integer primary key, album_title text, artistID integer, artist_name text,
+               year integer, record_labelID integer, label_name text, price real)""",
+        f"insert into AlbumListing ({album_listing_columns}) {album_listing_join}",
+        # keyset paging in every sort order reads an index in order
+        "create index if not exists AlbumListing_title on AlbumListing (album_title, albumID)",
+        "create index if not exists AlbumListing_artist_name on AlbumListing (artist_name, albumID)",
+        "create index if not exists AlbumListing_year on AlbumListing (year, albumID)",
+        "create index if not exists AlbumListing_price on AlbumListing (price, albumID)",
+        # for the triggers on Artists and RecordLabels
+        "create index if not exists AlbumListing_artist on AlbumListing (artistID)",
+        "create index if not exists AlbumListing_label on AlbumListing (record_labelID)",
+        "analyze AlbumListing",
+        # an album's row is rebuilt from the join whenever the album changes
+        f"""create trigger if not exists Albums_listing_insert after insert on Albums begin
+                insert into AlbumListing ({album_listing_columns})
+                {album_listing_join} where Albums.albumID = new.albumID;
+            end""",
+        f"""create trigger if not exists Albums_listing_update after update on Albums begin
+                delete from AlbumListing where albumID = old.albumID;
+                insert into AlbumListing ({album_listing_columns})
+                {album_listing_join} where Albums.albumID = new.albumID;
+            end""",
+        """create trigger if not exists Albums_listing_delete after delete on Albums begin
+               delete from AlbumListing where albumID = old.albumID;
+           end""",
+    ] + [
+        # when an artist or label changes, so do the rows of its albums. An
+        # album only has a row if its artist and label exist, so inserts and
+        # deletes can add or remove rows too.
+        statement
+        for table, id_column, ref_column in (("Artists", "artistID", "artistRef"),
+                                             ("RecordLabels", "record_labelID", "record_labelRef"))
+        for statement in (
+            f"""create trigger if not exists {table}_listing_insert after insert on {table} begin
+                    insert or replace into AlbumListing ({album_listing_columns})
+                    {album_listing_join} where Albums.{ref_column} = new.{id_column};
+                end""",
+            f"""create trigger if not exists {table}_listing_update after update on {table} begin
+                    delete from AlbumListing where {id_column} in (old.{id_column}, new.{id_column});
+                    insert into AlbumListing ({album_listing_columns})
+                    {album_listing_join} where Albums.{ref_column} = new.{id_column};
+                end""",
+            f"""create trigger if not exists {table}_listing_delete after delete on {table} begin
+                    delete from AlbumListing where {id_column} = old.{id_column};
+                end""",
+        )
+    ]),
+    (4, "DataVersion: a token that changes with every write, the same in every process", [
+        """create table if not exists DataVersion (
+               versionID integer primary key check (versionID = 1),
+               token text not null, changed_time real not null)""",
+        f"""insert or ignore into DataVersion (versionID, token, changed_time)
+            values (1, {new_data_token}, {data_time_now})""",
+    ]),
+]
+
+latest_version = migrations[-1][0]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn, verbose=False):
+    """Bring the database up to latest_version. Each migration runs in its own
+       transaction together with the update of user_version, so a failed
+       migration leaves the database at the previous version. BEGIN IMMEDIATE
+       takes the write lock before the version is read, so several processes
+       can start at once without running a migration twice.
+
+       Parameters:
+       conn: sqlite3 connection
+       verbose: print each migration as it is applied
+
+       Returns: the schema version
+    """
+    if schema_version(conn) >= latest_version:
+        return schema_version(conn)
+
+    conn.commit()
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None         # manage the transactions ourselves
+    try:
+        for version, description, statements in migrations:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if schema_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                if verbose:
+                    print(f"Applying migration {version}: {description}")
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+    return schema_version(conn)
+
+def stamp_data_version(cursor):
+    """record that the data has changed: a new DataVersion token and time.
+       Call it in the transaction that made the change.
+    """
+    cursor.execute(stamp_data_version_sql)
+
+def rebuild_album_listing(conn):
+    """Rebuild AlbumListing from the base tables, in one transaction
+
+       Returns: number of rows in AlbumListing
+    """
+    with conn:
+        conn.execute("delete from AlbumListing")
+        conn.execute(f"insert into AlbumListing ({album_listing_columns}) {album_listing_join}")
+    return conn.execute("select count(*) from AlbumListing").fetchone()[0]
+
+def check_album_listing(conn, limit=20):
+    """Compare AlbumListing with the join it is meant to hold
+
+       Returns: (missing, extra) - up to limit rows of the join that aren't
+                in AlbumListing (or are different there), and up to limit
+                rows of AlbumListing that aren't in the join
+    """
+    listing = f"select {album_listing_columns} from AlbumListing"
+    missing = conn.execute(f"{album_listing_join} except {listing} limit ?", (limit,)).fetchall()
+    extra = conn.execute(f"{listing} except {album_listing_join} limit ?", (limit,)).fetchall()
+    return missing, extra
+
+def hot_queries():
+    """The queries the server runs for every page, with example parameters.
+       check_query_plans() looks at how SQLite runs each of them.
+
+       Returns: dictionary of name: (query, params)
+    """
+    listings = {
+        "albums": (albumsdb.album_columns, albumsdb.album_tables, "albumID", albumsdb.album_sorts),
+        "artists": (albumsdb.artist_columns, "Artists", "artistID", albumsdb.artist_sorts),
+        "labels": (albumsdb.label_columns, "RecordLabels", "record_labelID", albumsdb.label_sorts),
+    }
+    queries = {
+        "tracks for album": (albumsdb.tracks_query, (1,)),
+        "artist exists": ("select artistID from Artists where artist_name = ?", ("Chicago",)),
+        "label exists": ("select record_labelID from RecordLabels where label_name = ?", ("Arista",)),
+        "search": (albumsdb.search_query, (albumsdb.search_expression("love"), 21, 0)),
+    }
+    # first page and a later page (forwards and backwards) of every sort order
+    for listing, (columns, tables, id_column, sorts) in listings.items():
+        for sort, sort_column in sorts.items():
+            for reverse in (False, True):
+                for cursor_id in (None, 1):
+                    name = (listing + " page by " + sort + (" desc" if reverse else "") +
+                            (" after" if cursor_id else ""))
+                    queries[name] = albumsdb.keyset_query(columns, tables, id_column, sort_column,
+                                                          reverse, cursor_id, 51)
+    return queries
+
+def full_scans(plan):
+    """the steps of a query plan that read a whole table or sort the whole
+       result: "SCAN table" without an index, or a temporary b-tree for ORDER BY
+    """
+    return [detail for detail in plan
+            if (detail.startswith("SCAN ") and " INDEX " not in detail)
+            or detail.startswith("USE TEMP B-TREE FOR ORDER BY")]
+
+def check_query_plans(conn, queries=None):
+    """Run EXPLAIN QUERY PLAN for each hot query
+
+       Returns: dictionary of query name: (plan steps, full scan steps)
+    """
+    results = {}
+    for name, (query, params) in (queries or hot_queries()).items():
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+        results[name] = (plan, full_scans(plan))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the AlbumServer database")
+    parser.add_argument("--db", default=r"..\database\albums.db", help="database file")
+    parser.add_argument("--check", action="store_true",
+                        help="show the query plan of each hot query, exit 1 if any do a full scan")
+    parser.add_argument("--rebuild-listing", action="store_true",
+                        help="rebuild the AlbumListing table from Albums, Artists and RecordLabels")
+    parser.add_argument("--check-listing", action="store_true",
+                        help="compare AlbumListing with the base tables, exit 1 if they differ")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    print(f"Schema version {apply_migrations(conn, verbose=True)}")
+
+    if args.rebuild_listing:
+        start = time.perf_counter()
+        rows = rebuild_album_listing(conn)
+        print(f"Rebuilt AlbumListing: {rows} albums in {time.perf_counter() - start:.2f} seconds")
+
+    if args.check_listing:
+        missing, extra = check_album_listing(conn)
+        for row in missing:
+            print("MISSING " + repr(row))
+        for row in extra:
+            print("EXTRA   " + repr(row))
+        if missing or extra:
+            conn.close()
+            sys.exit("AlbumListing doesn't match the base tables. "
+                     "Fix it with: python migrations.py --rebuild-listing")
+        print("AlbumListing matches the base tables")
+
+    if args.check:
+        failed = False
+        for name, (plan, scans) in check_query_plans(conn).items():
+            print(("FULL SCAN " if scans else "ok        ") + name)
+            for detail in plan:
+                print("          " + detail)
+            failed = failed or bool(scans)
+        conn.close()
+        sys.exit(1 if failed else 0)
+    conn.close()
@@ -0,0 +1,173 @@
+""" Rendered page cache for AlbumServer.
+
+    Most requests are reads, and the pages only change when something is
+    added to the database (or a template file is edited). Each rendered page
+    is kept here as encoded bytes along with the version it was built from:
+    the database's data generation and the template's version. A cached page
+    is only used if the version still matches, so a write to the database
+    invalidates every page without having to track which pages it affected.
+
+    Each cached page also carries the validators used for conditional GETs:
+    an ETag (a hash of the page, so it is the same in every server process)
+    and a Last-Modified time (when the page was rendered). Compressed versions
+    of the page (see compression.py) are kept with it once they are built.
+    A page that is streamed to the browser as it is rendered can't be hashed
+    before it is sent, so its validators come from the data and template it
+    is built from instead (see version_validators). Those are the same in
+    every server process too.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+import compression
+
+class Validators:
+    """The ETag and modification time of a page, for conditional GETs
+
+       Parameters:
+       etag: the page's ETag (quoted)
+       modified_time: when the page last changed, in whole seconds
+    """
+
+    def __init__(self, etag, modified_time):
+        self.etag = etag
+        self.set_modified_time(modified_time)
+
+    def encoding_etag(self, encoding):
+        """the ETag of the page in the given content encoding. Each encoding
+           has its own ETag, as required for strong validators.
+        """
+        if encoding == "identity":
+            return self.etag
+        return self.etag[:-1] + "-" + encoding + '"'
+
+    def set_modified_time(self, modified_time):
+        """http dates only have 1 second resolution, so modified_time is in
+           whole seconds
+        """
+        self.modified_time = modified_time
+
+    @property
+    def last_modified(self):
+        """the Last-Modified header. modified_time can be a second ahead of
+           the clock (see PageCache.put and version_validators), but the
+           header must never be in the future.
+        """
+        return formatdate(min(self.modified_time, int(time.time())), usegmt=True)
+
+class Page(Validators):
+    """A rendered page and its validators
+
+       Parameters:
+       body: the encoded page (bytes)
+       validators: Validators the page was sent with while it was streamed,
+                   or None to use a hash of the page and the current time
+    """
+
+    def __init__(self, body, validators=None):
+        self.body = body
+        if validators is None:
+            super().__init__('"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"',
+                             int(time.time()))
+        else:
+            super().__init__(validators.etag, validators.modified_time)
+        self.variants = {"identity": body}      # encoding: body
+
+    def variant(self, encoding):
+        """Return (body, etag) for the page in the given content encoding.
+           The compressed body is built the first time it is asked for.
+        """
+        body = self.variants.get(encoding)
+        if body is None:
+            body = compression.compress(self.body, encoding)
+            self.variants[encoding] = body
+        return body, self.encoding_etag(encoding)
+
+def version_validators(data_token, route, template_version, changed_time):
+    """Validators for the page for route, known before the page is rendered
+
+       Parameters:
+       data_token: the database's data version token (see albumsDB.data_stamp)
+       route: page cache key
+       template_version: the template's version
+       changed_time: when the data or the template last changed (seconds)
+       
+       Returns: Validators
+    """
+    key = repr((data_token, route, template_version)).encode("utf-8")
+    etag = '"v' + hashlib.blake2b(key, digest_size=12).hexdigest() + '"'
+    # a browser's copy is only unmodified if it is dated after the last
+    # change. Dates are whole seconds, so that is the second after it.
+    return Validators(etag, int(changed_time) + 1)
+
+class PageCache:
+    """Rendered pages keyed by route (eg "/albums", "/tracks?ID=4")
+
+       Parameters:
+       max_pages: maximum number of pages kept. When the cache is full the
+                  oldest page is dropped.
+    """
+
+    def __init__(self, max_pages=256):
+        self.max_pages = max_pages
+        self.pages = {}             # route: (version, Page)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, route, version):
+        """return the cached page for route if it was built from version,
+           otherwise None
+        """
+        entry = self.pages.get(route)
+        if entry is not None and entry[0] != version:
+            entry = None
+        # += isn't atomic, so the counts are kept under the lock
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if entry is None else entry[1]
+
+    def put(self, route, version, page):
+        """store a Page rendered from version"""
+        with self.lock:
+            old = self.pages.get(route)
+            if old is not None:
+                old_page = old[1]
+                if old_page.etag == page.etag:
+                    # same page as before, so it hasn't really been modified
+                    page.set_modified_time(old_page.modified_time)
+                elif page.modified_time <= old_page.modified_time:
+                    # changed within the same second - make sure If-Modified-Since
+                    # doesn't treat the new page as unmodified
+                    page.set_modified_time(old_page.modified_time + 1)
+            elif len(self.pages) >= self.max_pages:
+                # dictionaries keep insertion order, so the first key is the oldest
+                del self.pages[next(iter(self.pages))]
+            self.pages[route] = (version, page)
+
+    def discard(self, prefix):
+        """drop every page whose route starts with prefix"""
+        with self.lock:
+            for route in [route for route in self.pages if route.startswith(prefix)]:
+                del self.pages[route]
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
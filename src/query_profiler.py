@@ -0,0 +1,255 @@
+""" Slow query profiler for the AlbumServer database.
+
+    When a page is slow it isn't obvious whether the time goes on the query
+    itself, on fetching the rows, or on rendering the page. With profiling
+    turned on (web_server.py --slow-query-ms N) every statement albumsDB runs
+    is timed from execute() until its last row has been fetched. Any
+    statement that takes longer than the threshold is logged with:
+
+        * the normalized SQL (whitespace collapsed, literal values replaced
+          by ?), so the same query with different values is one entry
+        * the number of bind parameters (for executemany, the number of
+          parameter sets) and the number of rows returned
+        * how many statements SQLite ran for it, including triggers (from
+          sqlite3's trace callback)
+        * its EXPLAIN QUERY PLAN output
+
+    Every statement, slow or not, is added to a summary by normalized SQL.
+    report() lists the statements that took the most time in total; the
+    server shows it at /query_report and prints it when it stops.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import collections
+import re
+import sqlite3
+import threading
+import time
+
+# hardcoded global parameters
+slow_log_size = 100             # number of slow statements kept for the report
+
+whitespace_re = re.compile(r"\s+")
+literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# only "in (?, ?, ...)" lists are collapsed. "values (?, ?, ?)" keeps its
+# length, so inserts into different columns aren't reported as one statement.
+in_list_re = re.compile(r"\b(in)\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+
+def normalize_sql(sql):
+    """sql with whitespace collapsed and literal strings and numbers
+       replaced by ?, eg "select * from Albums where albumID = 4" becomes
+       "select * from Albums where albumID = ?"
+    """
+    sql = literal_re.sub("?", sql)
+    sql = in_list_re.sub(r"\1 (?)", sql)
+    return whitespace_re.sub(" ", sql).strip()
+
+class QueryProfiler:
+    """Times statements run through ProfiledConnection connections
+
+       Parameters:
+       threshold_ms: statements that take longer than this are logged
+       log: function called with the text of each slow statement entry
+    """
+
+    def __init__(self, threshold_ms, log=print):
+        self.threshold = threshold_ms / 1000
+        self.log = log
+        # reentrant: a cursor that is garbage collected finishes its
+        # statement, which can happen while this thread holds the lock
+        self.lock = threading.RLock()
+        self.totals = {}            # normalized sql: [count, total seconds, max seconds, rows]
+        self.slow = collections.deque(maxlen=slow_log_size)
+        self.plans = {}             # normalized sql: query plan
+        self.local = threading.local()
+
+    def trace(self, statement):
+        """sqlite3 trace callback: counts the statements SQLite runs
+           (including trigger programs) for the statement being profiled
+        """
+        self.local.statements = getattr(self.local, "statements", 0) + 1
+
+    def start_statement(self):
+        self.local.statements = 0
+
+    def statements_run(self):
+        return getattr(self.local, "statements", 0)
+
+    def finish_statement(self, conn, sql, param_count, rows, statements, seconds):
+        """add a finished statement to the totals and log it if it was slow"""
+        normalized = normalize_sql(sql)
+        with self.lock:
+            total = self.totals.get(normalized)
+            if total is None:
+                total = self.totals[normalized] = [0, 0.0, 0.0, 0]
+            total[0] += 1
+            total[1] += seconds
+            total[2] = max(total[2], seconds)
+            total[3] += rows
+        if seconds < self.threshold:
+            return
+
+        entry = (f"Slow query: {seconds * 1000:.1f} ms, {param_count} parameters, "
+                 f"{rows} rows, {statements} statements run\n"
+                 f"  {normalized}\n" +
+                 "".join(f"  plan: {detail}\n" for detail in self.query_plan(conn, sql, normalized)))
+        self.slow.append(entry)
+        self.log(entry)
+
+    def query_plan(self, conn, sql, normalized):
+        """EXPLAIN QUERY PLAN for sql (worked out once per normalized statement)"""
+        plan = self.plans.get(normalized)
+        if plan is None:
+            # a plain cursor, so the EXPLAIN itself isn't profiled. The plan
+            # doesn't depend on the values, so bind NULLs.
+            cursor = sqlite3.Cursor(conn)
+            try:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count("?"))
+                plan = [row[3] for row in cursor.fetchall()]
+            except sqlite3.Error as e:
+                plan = ["(no plan: " + str(e) + ")"]
+            finally:
+                cursor.close()
+            self.plans[normalized] = plan
+        return plan
+
+    def report(self, top=20):
+        """the top statements by total time, as text"""
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)
+            slow = list(self.slow)
+        lines = [f"Top {top} statements by total time "
+                 f"(threshold for logging {self.threshold * 1000:g} ms)",
+                 f"{'total ms':>10}{'count':>8}{'avg ms':>9}{'max ms':>9}{'rows':>9}  statement"]
+        for sql, (count, seconds, longest, rows) in totals[:top]:
+            lines.append(f"{seconds * 1000:>10.1f}{count:>8}{seconds / count * 1000:>9.2f}"
+                         f"{longest * 1000:>9.2f}{rows:>9}  {sql}")
+        lines.append("")
+        lines.append(f"Last {len(slow)} slow statements:")
+        lines.extend(slow)
+        return "\n".join(lines) + "\n"
+
+class ProfiledCursor(sqlite3.Cursor):
+    """A cursor that times each statement from execute() until its rows have
+       all been fetched (or the cursor is closed, thrown away or runs another
+       statement)
+    """
+
+    # [sql, parameter count, rows, statements run, seconds] of the statement in progress
+    current = None
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        profiler = self.connection.profiler
+        profiler.start_statement()
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        finally:
+            self.current = [sql, len(parameters), 0, profiler.statements_run(),
+                            time.perf_counter() - start]
+        if self.description is None:
+            # not a query (eg insert), so there are no rows to wait for
+            self.current[2] = max(self.rowcount, 0)
+            self.finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        profiler = self.connection.profiler
+        profiler.start_statement()
+        if hasattr(seq_of_parameters, "__len__"):
+            param_sets = len(seq_of_parameters)
+        else:
+            # a generator: count the parameter sets as sqlite3 takes them
+            param_sets = 0
+            def counted(seq):
+                nonlocal param_sets
+                for parameters in seq:
+                    param_sets += 1
+                    yield parameters
+            seq_of_parameters = counted(seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        finally:
+            self.current = [sql, param_sets, max(self.rowcount, 0), profiler.statements_run(),
+                            time.perf_counter() - start]
+            self.finish()
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(0 if row is None else 1, time.perf_counter() - start, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.fetched(len(rows), time.perf_counter() - start,
+                     len(rows) < (self.arraysize if size is None else size))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(len(rows), time.perf_counter() - start, True)
+        return rows
+
+    def fetched(self, rows, seconds, finished):
+        if self.current is not None:
+            self.current[2] += rows
+            self.current[4] += seconds
+            if finished:
+                self.finish()
+
+    def finish(self):
+        """the statement in progress is finished, report it"""
+        if self.current is not None:
+            sql, param_count, rows, statements, seconds = self.current
+            self.current = None
+            self.connection.profiler.finish_statement(self.connection, sql, param_count,
+                                                      rows, statements, seconds)
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        # eg conn.execute(...).fetchone(): the cursor is thrown away without
+        # fetching the end of its rows
+        self.finish()
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3 connection whose cursors are ProfiledCursors. Use it as the
+       factory for sqlite3.connect(), then call attach().
+    """
+
+    profiler = None
+
+    def attach(self, profiler):
+        self.profiler = profiler
+        self.set_trace_callback(profiler.trace)
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute runs the statement on its cursor without
+    # calling the cursor's execute(), so it wouldn't be timed
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,190 @@
+r""" Replays an AlbumServer access log against a server.
+
+    benchmark.py sends a made up mix of requests. To benchmark with the
+    requests real users actually sent, record them with the server's access
+    log (web_server.py --access-log file, see access_log.py) and replay the
+    log, against the same server after a change or against another one:
+
+        python replay.py ..\logs\access.log
+        python replay.py ..\logs\access.log --speed 10 --json after.json
+        python benchmark.py --compare before.json after.json
+
+    Requests are sent at the times they were made in the log, relative to
+    the first one. --speed 2 replays them twice as fast, --speed 0 as fast
+    as --concurrency clients can send them. Latency is measured from when
+    each request was due, so a server that falls behind shows it.
+
+    The log doesn't keep the form data, so POSTs to the add forms are sent
+    with new made up values (as in benchmark.py). Bulk track uploads and
+    /admin/reset are left out, and --read-only leaves out every POST.
+    Requests made for a tenant are sent for the same tenant.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import argparse
+import json
+import queue
+import random
+import sys
+import threading
+import time
+import access_log
+import benchmark
+import metrics
+
+# hardcoded global parameters
+default_concurrency = benchmark.default_concurrency
+
+# the benchmark.py form for each POST that can be replayed
+post_forms = {"/add_artist": "post artist", "/add_label": "post label",
+              "/add_album": "post album", "/add_track": "post track"}
+
+def load_requests(file_name, read_only=False, limit=None):
+    """Read the requests to replay from an access log
+
+       Returns: (requests, skipped). requests is a list of (seconds after the
+                first request, method, path, tenant, status in the log),
+                skipped is a dictionary of reason: number of requests
+    """
+    entries = []
+    skipped = {}
+    for entry in access_log.read_log(file_name):
+        method = entry.get("method")
+        path = entry.get("path", "")
+        if method == "POST" and (read_only or path not in post_forms):
+            reason = "POST (--read-only)" if read_only else "POST " + path
+        elif method not in ("GET", "POST"):
+            reason = str(method)
+        else:
+            entries.append(entry)
+            continue
+        skipped[reason] = skipped.get(reason, 0) + 1
+    # the log is written in batches, so it is only roughly in time order
+    entries.sort(key=lambda entry: entry["time"])
+    if limit is not None:
+        entries = entries[:limit]
+    first = entries[0]["time"] if entries else 0
+    requests = [(entry["time"] - first, entry["method"], entry["path"], entry.get("tenant"),
+                 entry.get("status")) for entry in entries]
+    return requests, skipped
+
+def replay(host, port, requests, speed=1.0, concurrency=default_concurrency, max_album_id=30,
+           seed="1"):
+    """Send the requests, on the log's schedule sped up by speed (0 for no
+       schedule, as fast as the clients can)
+
+       Returns: (results dictionary as from benchmark.summarize, number of 
+                responses whose status was different from the log's)
+    """
+    recorder = benchmark.Recorder()
+    # a short queue, so that with speed 0 the clients aren't handed the
+    # whole log at once
+    work = queue.Queue(maxsize=concurrency * 4)
+    status_changes = [0]
+    lock = threading.Lock()
+
+    def worker(number):
+        rng = random.Random(f"{seed}-{number}")
+        clients = {}                # a keep-alive connection for each tenant
+        try:
+            while True:
+                item = work.get()
+                if item is None:
+                    break
+                due, (offset, method, path, tenant, logged_status) = item
+                if due is None:
+                    due = time.perf_counter()
+                client = clients.get(tenant)
+                if client is None:
+                    headers = {"X-Tenant": tenant} if tenant else None
+                    client = clients[tenant] = benchmark.Client(host, port, "gzip, deflate",
+                                                                headers)
+                fields = None
+                if method == "POST":
+                    fields = benchmark.form_fields(post_forms[path], rng, max_album_id)
+                status, size = client.request(method, path, fields)
+                recorder.record(method + " " + metrics.route_name(path), status,
+                                time.perf_counter() - due, size)
+                # the replay doesn't send If-None-Match, so a 304 in the log is a 200 now
+                if status != logged_status and not (logged_status == 304 and status == 200):
+                    with lock:
+                        status_changes[0] += 1
+        finally:
+            for client in clients.values():
+                client.close()
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    for request in requests:
+        due = None
+        if speed:
+            # if every client is busy the request waits in the queue, and
+            # the wait counts as latency
+            due = start + request[0] / speed
+            time.sleep(max(0.0, due - time.perf_counter()))
+        work.put((due, request))
+    for thread in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    settings = {"host": host, "port": port, "speed": speed, "concurrency": concurrency,
+                "requests": len(requests)}
+    return benchmark.summarize(recorder, elapsed, settings), status_changes[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay an AlbumServer access log")
+    parser.add_argument("log", help="access log written by web_server.py --access-log")
+    parser.add_argument("--host", default=benchmark.default_host)
+    parser.add_argument("--port", type=int, default=benchmark.default_port)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay this many times faster than the log (0 = as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=default_concurrency,
+                        help="number of simultaneous clients")
+    parser.add_argument("--read-only", action="store_true", help="don't send the POSTs")
+    parser.add_argument("--limit", type=int, help="only replay the first LIMIT requests")
+    parser.add_argument("--max-album-id", type=int, default=30,
+                        help="highest album ID used for the track POSTs (default 30)")
+    parser.add_argument("--seed", default="1", help="random seed for the POSTs' values")
+    parser.add_argument("--json", help="save the results to this file (see benchmark.py --compare)")
+    args = parser.parse_args()
+
+    try:
+        requests, skipped = load_requests(args.log, args.read_only, args.limit)
+    except OSError as e:
+        print(e)
+        sys.exit("Unable to read " + args.log + ". Program exiting.")
+    if not requests:
+        sys.exit("No requests to replay in " + args.log + ". Program exiting.")
+    for reason, count in sorted(skipped.items()):
+        print(f"Leaving out {count} requests: {reason}")
+    length = requests[-1][0]
+    if args.speed:
+        print(f"Replaying {len(requests)} requests ({length:.1f} seconds of traffic) at "
+              f"{args.speed:g}x speed against http://{args.host}:{args.port}...")
+    else:
+        print(f"Replaying {len(requests)} requests as fast as possible against "
+              f"http://{args.host}:{args.port}...")
+    results, status_changes = replay(args.host, args.port, requests, args.speed,
+                                     args.concurrency, args.max_album_id, args.seed)
+    benchmark.print_results(results)
+    if status_changes:
+        print(f"{status_changes} responses had a different status than in the log")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to " + args.json)
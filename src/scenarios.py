@@ -0,0 +1,435 @@
+r""" HTTP scenario runner for AlbumServer.
+
+    Runs the same flows as the Selenium scripts in the selenium directory,
+    but talks to the server directly over HTTP and reads the html it sends
+    back, so no browser is needed and nothing sleeps between steps:
+
+        SimpleTest1       log in, pick the first 2 albums and check their
+                          prices and the total field
+        SelectRandomRow   log in, pick a random album and check its price
+                          and the total field
+        AddArtists        log in, add every artist in datafiles\Artists.csv
+                          with the Add Artist form and check that each one
+                          can be found (with the site's search page)
+
+    A scenario is just a function that drives a VirtualUser, so the same
+    definition is used to check that the site works (one user, a message for
+    each step, like the Selenium scripts) and to load test it (many users at
+    once, each in its own thread, for --duration seconds):
+
+        python scenarios.py
+        python scenarios.py SelectRandomRow AddArtists --iterations 5
+        python scenarios.py --users 50 --duration 60 --tenant-per-user
+
+    The page's javascript doesn't run. Where a Selenium script clicks
+    checkboxes and compares the prices with the total the page's Add2Total
+    function works out, the scenario can't check the total itself (only a
+    browser can). It checks what the total is worked out from instead: each
+    chosen row has a price and a checkbox that calls Add2Total, and the
+    total field starts at 0 (see check_prices).
+
+    Every step is timed, and the results are printed like benchmark.py's.
+    The exit status is 1 if any scenario failed.
+
+    NOTE: AddArtists adds artists to the database. With more than one user
+    or iteration the names get a suffix so every artist added is new. Start
+    the server in tenant mode (web_server.py --tenants) and use
+    --tenant-per-user to give every virtual user a database of its own.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urlencode, urlsplit
+import benchmark
+
+# hardcoded global parameters
+artists_file = r"..\datafiles\Artists.csv"
+login_name = "bob"
+
+class ScenarioFailed(Exception):
+    """a check in a scenario failed"""
+
+class Page(HTMLParser):
+    """The parts of an html page the scenarios look at
+
+       title: the page title
+       links: list of (link text, path)
+       elements: attributes of each element with an id (first one only), by id
+       tables: rows of each table with an id, by id. A row is a list of the
+               text in its <td> cells (header rows are left out).
+       row_checkboxes: attributes of the checkbox in each table row that has
+                       one, in order
+       forms: list of forms, each a dictionary with "action", "method" and
+              "fields" (names of its inputs)
+    """
+
+    def __init__(self, text):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.links = []
+        self.elements = {}
+        self.tables = {}
+        self.forms = []
+        self.row_checkboxes = []
+        # text being collected for the title, a link and a table cell
+        self.title_text = None
+        self.link_text = None
+        self.cell_text = None
+        self.link = None
+        self.table = None
+        self.row = None
+        self.feed(text)
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if "id" in attrs:
+            self.elements.setdefault(attrs["id"], attrs)
+        if tag == "title":
+            self.title_text = []
+        elif tag == "a" and "href" in attrs:
+            # links are absolute (http://localhost:9000/albums), keep the path
+            parts = urlsplit(attrs["href"])
+            self.link = parts.path + ("?" + parts.query if parts.query else "")
+            self.link_text = []
+        elif tag == "table" and "id" in attrs:
+            self.table = self.tables[attrs["id"]] = []
+        elif tag == "tr" and self.table is not None:
+            self.row = []
+        elif tag == "td" and self.row is not None:
+            self.cell_text = []
+        elif tag == "form":
+            self.forms.append({"action": attrs.get("action", ""),
+                               "method": attrs.get("method", "GET").upper(), "fields": []})
+        elif tag in ("input", "select", "textarea") and self.forms and attrs.get("name"):
+            self.forms[-1]["fields"].append(attrs["name"])
+        if tag == "input" and attrs.get("type") == "checkbox" and self.row is not None:
+            self.row_checkboxes.append(attrs)
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.title_text is not None:
+            self.title = "".join(self.title_text).strip()
+            self.title_text = None
+        elif tag == "a" and self.link is not None:
+            self.links.append(("".join(self.link_text).strip(), self.link))
+            self.link = None
+            self.link_text = None
+        elif tag == "td" and self.cell_text is not None:
+            self.row.append("".join(self.cell_text).strip())
+            self.cell_text = None
+        elif tag == "tr" and self.row is not None:
+            if self.row:
+                self.table.append(self.row)
+            self.row = None
+        elif tag == "table":
+            self.table = None
+
+    def handle_data(self, data):
+        for text in (self.title_text, self.link_text, self.cell_text):
+            if text is not None:
+                text.append(data)
+
+    def link_to(self, text):
+        """the path of the first link with this text, or None"""
+        for link_text, path in self.links:
+            if link_text == text:
+                return path
+        return None
+
+class VirtualUser:
+    """One simulated user with its own keep-alive connection
+
+       Parameters:
+       host, port: the server
+       number: the user's number, used in names it adds
+       recorder: benchmark.Recorder that gets the time taken by each step
+       rng: random.Random for the user's choices
+       tenant: sent as X-Tenant with every request, or None
+       verbose: print a message for each step
+       unique_names: add a suffix to names added, so they are always new
+    """
+
+    def __init__(self, host, port, number, recorder, rng, tenant=None, verbose=False,
+                 unique_names=False):
+        headers = {"X-Tenant": tenant} if tenant else None
+        self.client = benchmark.Client(host, port, None, headers)
+        self.number = number
+        self.recorder = recorder
+        self.rng = rng
+        self.verbose = verbose
+        self.unique_names = unique_names
+        self.names_added = 0
+
+    def request(self, step, method, path, fields=None):
+        """send a request, record how long it took under step and check it
+           worked
+
+           Returns: the response as a Page
+        """
+        start = time.perf_counter()
+        status, body = self.client.fetch(method, path, fields)
+        self.recorder.record(step, status, time.perf_counter() - start, len(body))
+        self.check(status == 200, f"{step}: {method} {path} returned status {status}")
+        return Page(body.decode("utf-8", errors="replace"))
+
+    def get(self, step, path):
+        return self.request(step, "GET", path)
+
+    def follow(self, step, page, text):
+        """click the link with this text"""
+        path = page.link_to(text)
+        self.check(path is not None, f"{step}: no {text} link on the {page.title} page")
+        return self.get(step, path)
+
+    def submit(self, step, form, values):
+        """fill in a form and submit it, like clicking its submit button"""
+        missing = [name for name in values if name not in form["fields"]]
+        self.check(not missing, f"{step}: the form has no {', '.join(missing)} field")
+        action = form["action"] or "/"
+        if not action.startswith("/"):
+            action = "/" + action
+        if form["method"] == "POST":
+            return self.request(step, "POST", action, values)
+        # anything else (the login form says LINK) is sent as a GET
+        return self.get(step, action + "?" + urlencode(values))
+
+    def check(self, condition, message):
+        if not condition:
+            raise ScenarioFailed(message)
+
+    def say(self, message):
+        if self.verbose:
+            print(message)
+
+    def new_name(self, name):
+        """name, made unique to this user if unique_names is set"""
+        if not self.unique_names:
+            return name
+        self.names_added += 1
+        return f"{name} {benchmark.run_id}-{self.number}-{self.names_added}"
+
+    def close(self):
+        self.client.close()
+
+# the flows. Each step mirrors a step of the Selenium scripts.
+
+def login(user):
+    """log in on the fake login page
+
+       Returns: the albums page
+    """
+    page = user.get("login page", "/")
+    user.check("loginName" in page.elements and "loginBtn" in page.elements,
+               "The login page has no login form")
+    # the password is only checked by the login page's javascript
+    # (ValidatePW), it isn't sent to the server
+    page = user.submit("login", page.forms[0], {"loginName": login_name})
+    user.check(page.title == "Albums", "Login failed. Test terminated.")
+    user.say("Login Successfull")
+    return page
+
+def album_rows(user, page):
+    rows = page.tables.get("albums_table", [])
+    user.check(len(rows) >= 2, "Not enough data in table - test terminated.")
+    user.say("Table size: " + str(len(rows)))
+    return rows
+
+def check_prices(user, page, rows, checked):
+    """The Selenium scripts compare the prices of the checked rows added up
+       with the total the page's javascript works out. Without a browser,
+       check what that total is worked out from: each checked row has a
+       checkbox that calls Add2Total and a price in column 6, and the total
+       field starts at 0.
+    """
+    total = page.elements.get("total")
+    user.check(total is not None and total.get("value") == "0",
+               "Test failed. The page has no total field starting at 0")
+    for i in checked:
+        user.check(i < len(page.row_checkboxes) and
+                   "Add2Total()" in page.row_checkboxes[i].get("onclick", ""),
+                   "Test failed. Row " + str(i + 1) + " has no checkbox that updates the total")
+        try:
+            price = float(rows[i][5])
+        except ValueError:
+            price = -1
+        user.check(price >= 0, "Test failed. Row " + str(i + 1) + " has no price: " + rows[i][5])
+        user.say("Row " + str(i + 1) + " checked. Price: " + rows[i][5])
+    user.say("Test passed")
+
+def simple_test_1(user):
+    """SimpleTest1.py: select the first 2 albums and check their prices"""
+    page = login(user)
+    rows = album_rows(user, page)
+    check_prices(user, page, rows, [0, 1])
+
+def select_random_row(user):
+    """SelectRandomRow.py: select a random album and check its price"""
+    page = login(user)
+    rows = album_rows(user, page)
+    r = user.rng.randrange(0, len(rows) - 1)
+    check_prices(user, page, rows, [r])
+
+def add_artists(user):
+    """AddArtists.py: add each artist in artists_file, then check the
+       artist can be found
+    """
+    page = login(user)
+    for name, city, state in artists:
+        name = user.new_name(name)
+        user.say(name + '|' + city + '|' + state)
+        page = user.follow("add artist page", page, "Add Artist")
+        user.check(page.title == "Add an Artist", "Unable to find Add Artist page. Test terminated.")
+        user.say("Navigated to Add Artist page")
+        form = [form for form in page.forms if form["action"].endswith("add_artist")]
+        user.check(bool(form), "No add artist form on the Add Artist page")
+        page = user.submit("add artist", form[0],
+                           {"artist_name": name, "city": city, "state": state})
+        user.check(page.title == "Artists", "Adding " + name + " didn't show the Artists page")
+
+        # the Selenium script looks in the database, this asks the site
+        found = user.get("find artist", "/search?" + urlencode({"q": name}))
+        rows = found.tables.get("search_table", [])
+        user.check(["Artist", name] in rows, name + " not found after adding it")
+        user.say(name + " successfully added to database!")
+
+scenarios = {
+    "SimpleTest1": simple_test_1,
+    "SelectRandomRow": select_random_row,
+    "AddArtists": add_artists,
+}
+
+# the rows of artists_file, read once by read_artists
+artists = []
+
+def read_artists(file_name=artists_file):
+    if not os.access(file_name, os.R_OK):
+        sys.exit("Input csv file " + file_name + " not found. Program exiting.")
+    with open(file_name, newline="") as artists_csv_file:
+        artists.extend(row[:3] for row in csv.reader(artists_csv_file) if len(row) >= 3)
+
+def run(host, port, names, users=1, iterations=1, duration=None, seed="1",
+        tenant_per_user=False, verbose=False, unique_names=False):
+    """Run scenarios with several virtual users at once. Each user runs
+       every scenario in names, in order, iterations times. If duration is
+       given each user instead runs scenarios picked at random from names
+       until duration seconds have passed.
+
+       Returns: (results, passed, failures) - results as from
+                benchmark.summarize (by step), passed: dictionary of scenario
+                name: times passed, failures: list of (scenario, user, message)
+    """
+    recorder = benchmark.Recorder()
+    passed = {name: 0 for name in names}
+    failures = []
+    lock = threading.Lock()
+    deadline = None if duration is None else time.perf_counter() + duration
+
+    def virtual_user(number):
+        rng = random.Random(f"{seed}-{number}")
+        tenant = f"user{number}" if tenant_per_user else None
+        user = VirtualUser(host, port, number, recorder, rng, tenant, verbose, unique_names)
+        if deadline is None:
+            plan = names * iterations
+        else:
+            plan = iter(lambda: rng.choice(names), None)
+        try:
+            for name in plan:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+                if verbose:
+                    print(f"--- {name} (user {number})")
+                try:
+                    scenarios[name](user)
+                except ScenarioFailed as e:
+                    with lock:
+                        failures.append((name, number, str(e)))
+                    if verbose:
+                        print(e)
+                else:
+                    with lock:
+                        passed[name] += 1
+        finally:
+            user.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        for future in [executor.submit(virtual_user, number) for number in range(1, users + 1)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    settings = {"host": host, "port": port, "scenarios": names, "users": users,
+                "iterations": iterations, "duration": duration, "seed": seed,
+                "tenant_per_user": tenant_per_user}
+    return benchmark.summarize(recorder, elapsed, settings), passed, failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Selenium scripts' flows over plain HTTP")
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios to run: " + ", ".join(scenarios) + " (default all of them)")
+    parser.add_argument("--host", default=benchmark.default_host)
+    parser.add_argument("--port", type=int, default=benchmark.default_port)
+    parser.add_argument("--users", type=int, default=1, help="number of simultaneous virtual users")
+    parser.add_argument("--iterations", type=int, default=1,
+                        help="times each user runs each scenario")
+    parser.add_argument("--duration", type=float,
+                        help="run random scenarios for this many seconds instead")
+    parser.add_argument("--seed", default="1", help="random seed for the users' choices")
+    parser.add_argument("--tenant-per-user", action="store_true",
+                        help="give each user its own database (server in tenant mode)")
+    parser.add_argument("--unique-names", action="store_true",
+                        help="make the names added unique (always on for more than one run)")
+    parser.add_argument("--quiet", action="store_true", help="don't print each step")
+    parser.add_argument("--json", help="save the step timings to this file")
+    args = parser.parse_args()
+
+    names = args.scenarios or list(scenarios)
+    for name in names:
+        if name not in scenarios:
+            parser.error("unknown scenario " + name)
+    if "AddArtists" in names:
+        read_artists()
+    # one user running each scenario once talks through every step, like
+    # the Selenium scripts. A load test only prints the results.
+    single_run = args.users == 1 and args.iterations == 1 and args.duration is None
+    verbose = single_run and not args.quiet
+    unique_names = args.unique_names or not single_run
+
+    print(f"Running {', '.join(names)} against http://{args.host}:{args.port} "
+          f"with {args.users} users...")
+    results, passed, failures = run(args.host, args.port, names, args.users, args.iterations,
+                                    args.duration, args.seed, args.tenant_per_user, verbose,
+                                    unique_names)
+    print()
+    benchmark.print_results(results)
+    print()
+    for name in names:
+        failed = sum(1 for scenario, number, message in failures if scenario == name)
+        print(f"{name:<18}{passed[name]:>6} passed{failed:>6} failed")
+    for scenario, number, message in failures[:10]:
+        print(f"FAILED {scenario} (user {number}): {message}")
+    if args.json:
+        results["passed"] = passed
+        results["failures"] = failures
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to " + args.json)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,147 @@
+""" Snapshot and restore for the AlbumServer database.
+
+    Tests and benchmarks that add albums, artists and tracks change the
+    database, so each run starts from different data unless the database is
+    rebuilt first, and rebuilding it from the csv files takes a while.
+    Instead, save a snapshot of the freshly loaded database once and restore
+    it before each run.
+
+    Both directions use SQLite's online backup API, which copies the database
+    a page at a time under SQLite's own locking. So a snapshot can be saved
+    while the server is running, and restoring one replaces the contents of
+    the live database file in place: the server's open connections see the
+    restored data on their next query, the server notices the change (see
+    albumsDB.data_generation) so it stops sending pages cached from the old
+    data, and it doesn't need to be restarted. The server can also restore a snapshot itself, see POST
+    /admin/reset in web_server.py.
+
+    Usage:
+        python snapshot.py save [--db file] [--snapshot file]
+        python snapshot.py restore [--db file] [--snapshot file]
+        python snapshot.py build [--snapshot file] [--datadir directory]
+
+    build loads the csv files (see create_load_albumsdb.py) into an in-memory
+    database and saves that as the snapshot, without touching the database.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+import migrations
+
+# hardcoded global parameters
+database_file = r"..\database\albums.db"
+snapshot_file = r"..\database\albums.snapshot.db"
+backup_pages = -1           # pages copied per backup step, -1 copies them all in one step
+
+def copy_database(source, target):
+    """Copy the whole of database source into target with the backup API.
+       target's existing contents are replaced.
+
+       Parameters:
+       source: sqlite3 connection to copy from
+       target: sqlite3 connection to copy to (not in a transaction)
+    """
+    source.backup(target, pages=backup_pages)
+
+def save(database_file=database_file, snapshot_file=snapshot_file):
+    """Save a snapshot of database_file to snapshot_file"""
+    if not os.path.isfile(database_file):
+        raise FileNotFoundError(database_file + " not found")
+    source = sqlite3.connect(database_file)
+    target = sqlite3.connect(snapshot_file)
+    try:
+        copy_database(source, target)
+    finally:
+        target.close()
+        source.close()
+
+def restore_into(conn, snapshot_file=snapshot_file):
+    """Replace the contents of the database conn is connected to with
+       snapshot_file, then bring its schema up to date (the snapshot may be
+       older than the code) and give it a new data version (see
+       migrations.stamp_data_version), so pages from before the restore
+       aren't taken for pages of the restored data.
+
+       Returns: the schema version
+    """
+    if not os.path.isfile(snapshot_file):
+        raise FileNotFoundError(snapshot_file + " not found")
+    source = sqlite3.connect(snapshot_file)
+    try:
+        copy_database(source, conn)
+    finally:
+        source.close()
+    version = migrations.apply_migrations(conn)
+    with conn:
+        migrations.stamp_data_version(conn)
+    return version
+
+def restore(snapshot_file=snapshot_file, database_file=database_file):
+    """Restore snapshot_file over database_file (which may be in use)"""
+    conn = sqlite3.connect(database_file)
+    try:
+        return restore_into(conn, snapshot_file)
+    finally:
+        conn.close()
+
+def build(snapshot_file=snapshot_file, datadir=None):
+    """Load the csv files in datadir into a new database and save it as
+       snapshot_file
+    """
+    # imported here, create_load_albumsdb only matters for build
+    import create_load_albumsdb as loader
+    if datadir is None:
+        datadir = loader.datafiles_dir
+    conn = sqlite3.connect(":memory:")
+    try:
+        loader.create_tables(conn)
+        loader.prepare_for_load(conn)
+        for file_name, table_name, insert_sql in loader.load_files:
+            loader.load_csv(conn, table_name, os.path.join(datadir, file_name), insert_sql)
+        loader.finish_load(conn)
+        target = sqlite3.connect(snapshot_file)
+        try:
+            copy_database(conn, target)
+        finally:
+            target.close()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save or restore a snapshot of the AlbumServer database")
+    parser.add_argument("action", choices=("save", "restore", "build"))
+    parser.add_argument("--db", default=database_file, help="the database")
+    parser.add_argument("--snapshot", default=snapshot_file, help="the snapshot file")
+    parser.add_argument("--datadir", default=None, help="directory with the csv files (build)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        if args.action == "save":
+            save(args.db, args.snapshot)
+            print(f"Saved {args.db} to {args.snapshot}", end="")
+        elif args.action == "restore":
+            restore(args.snapshot, args.db)
+            print(f"Restored {args.snapshot} to {args.db}", end="")
+        else:
+            build(args.snapshot, args.datadir)
+            print(f"Built {args.snapshot}", end="")
+    except (OSError, sqlite3.Error) as e:
+        print(e)
+        sys.exit("Unable to " + args.action + " the snapshot. Program exiting.")
+    print(f" in {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,151 @@
+""" Compiled html templates for AlbumServer.
+
+    A template is an html file with {{name}} slots in it (eg {{links}},
+    {{db_records}}). Each template is read from disk once and split into
+    static segments and slot names. The static segments are stored as utf-8
+    encoded bytes, so rendering a page is a single join of the static
+    segments and the slot values. A template file is only re-read when its
+    modification time changes, so templates can still be edited while the
+    server is running.
+
+    A slot value can also be an iterable of strings (eg a generator that
+    formats one table row per database row). stream() then yields the page
+    in chunks as the rows are produced, so a large table never has to be in
+    memory all at once.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import os
+import re
+import threading
+
+slot_re = re.compile(r"\{\{(\w+)\}\}")
+
+# stream() gathers rows into chunks of about this many bytes
+chunk_size = 16384
+
+class Template:
+    """A template file split into static segments and slots
+
+       Parameters:
+       path: path/name of the html template file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        """read the template file and split it on {{slot}} markers
+
+           re.split returns static text and slot names alternately, starting
+           and ending with static text, so there is always one more static
+           segment than there are slots.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path) as f:
+            parts = slot_re.split(f.read())
+
+        segments = [part.encode("utf-8") for part in parts[0::2]]
+        slots = parts[1::2]
+
+        # replace both at once so other threads never see a half loaded template
+        self.compiled = (segments, slots)
+        self.mtime = mtime
+
+    @property
+    def version(self):
+        """changes whenever the template file is reloaded"""
+        return self.mtime
+
+    def reload_if_changed(self):
+        """re-read the template if the file has been modified"""
+        if os.stat(self.path).st_mtime_ns != self.mtime:
+            self.load()
+
+    def render(self, **values):
+        """return the page as bytes with each slot replaced by its value
+
+           Parameters:
+           values: slot name = str, bytes or an iterable of str. Slots without
+                   a value are left in the page unchanged.
+        """
+        return b"".join(self.stream(**values))
+
+    def stream(self, **values):
+        """yield the page as chunks of bytes. Static segments are yielded
+           as they are, iterable slot values are gathered into chunks of about
+           chunk_size bytes.
+        """
+        segments, slots = self.compiled
+        yield segments[0]
+        for slot, segment in zip(slots, segments[1:]):
+            value = values.get(slot)
+            if value is None:
+                value = "{{" + slot + "}}"
+            if isinstance(value, str):
+                yield value.encode("utf-8")
+            elif isinstance(value, bytes):
+                yield value
+            else:
+                chunk = []
+                size = 0
+                for text in value:
+                    chunk.append(text)
+                    size += len(text)
+                    if size >= chunk_size:
+                        yield "".join(chunk).encode("utf-8")
+                        chunk = []
+                        size = 0
+                if chunk:
+                    yield "".join(chunk).encode("utf-8")
+            yield segment
+
+class TemplateCache:
+    """Compiled templates by name
+
+       Parameters:
+       template_files: dictionary of template name: path/name of html file
+    """
+
+    def __init__(self, template_files):
+        self.template_files = template_files
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def preload(self):
+        """compile every template (call at server startup). Templates that
+           can't be read are reported and loaded again on first use.
+        """
+        for name in self.template_files:
+            try:
+                self.get(name)
+            except OSError as e:
+                print(e)
+
+    def get(self, name):
+        """return the compiled template for name, re-reading the file if it
+           has changed. Raises OSError if the file can't be read.
+        """
+        template = self.templates.get(name)
+        if template is None:
+            with self.lock:
+                template = self.templates.get(name)
+                if template is None:
+                    template = Template(self.template_files[name])
+                    self.templates[name] = template
+        else:
+            template.reload_if_changed()
+        return template
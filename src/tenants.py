@@ -0,0 +1,173 @@
+""" A separate database for each tenant, for running tests in parallel.
+
+    Tests that run at the same time against one albums.db get in each
+    other's way: one test adds an album another test expects not to be
+    there, add_artist skips an artist another test already added, and so on.
+    In tenant mode (web_server.py --tenants N) a request can name a tenant
+    and is then served from that tenant's own copy of the database, so every
+    test worker can use its own tenant name and see only its own changes.
+
+    The first time a tenant is seen, its database file is made from the seed
+    database (the snapshot, see snapshot.py) with the backup API, and opened
+    with its own albumsDB (connection pool and writer thread). Only the N
+    most recently used tenants are kept open. When another one is needed
+    the least recently used tenant that isn't serving a request is closed.
+    Its file is kept, so a closed tenant picks up where it left off when it
+    is used again. Each tenant starts from a fresh copy of the seed the
+    first time it is used after the server starts.
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import collections
+import os
+import re
+import threading
+from concurrent.futures import Future
+import albumsdb
+import snapshot
+
+# tenant names become file names, so only letters, digits, - and _
+tenant_id_re = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def valid_tenant_id(tenant_id):
+    return tenant_id_re.match(tenant_id) is not None
+
+class TenantDatabases:
+    """The open tenant databases, least recently used first
+
+       Parameters:
+       seed_file: database copied for each new tenant
+       tenant_dir: directory for the tenant database files
+       max_open: most tenants kept open at once
+       pool_size: database connections for each tenant
+       profiler: query_profiler.QueryProfiler shared by the tenants, or None
+       on_close: called with the tenant ID when a tenant is closed
+    """
+
+    def __init__(self, seed_file, tenant_dir, max_open, pool_size=2, profiler=None,
+                 on_close=None):
+        self.seed_file = seed_file
+        self.tenant_dir = tenant_dir
+        self.max_open = max_open
+        self.pool_size = pool_size
+        self.profiler = profiler
+        self.on_close = on_close
+        self.open = collections.OrderedDict()  # tenant ID: [Future for its albumsDB, requests using it]
+        self.seeded = set()                     # tenants copied from the seed since startup
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+
+    def tenant_file(self, tenant_id):
+        return os.path.join(self.tenant_dir, tenant_id + ".db")
+
+    def acquire(self, tenant_id):
+        """open the tenant's database if it isn't open already and mark it
+           in use until release() is called. The tenant is opened (seed
+           copied, migrations applied, connections opened) without holding
+           the lock, so requests for other tenants don't wait for it. Other
+           requests for the same tenant wait for it to be opened.
+           
+           Raises OSError or sqlite3.Error if the tenant can't be opened.
+        """
+        with self.lock:
+            entry = self.open.get(tenant_id)
+            if entry is None:
+                # placeholder until the database is open
+                entry = self.open[tenant_id] = [Future(), 1]
+                opening = True
+            else:
+                self.open.move_to_end(tenant_id)
+                entry[1] += 1
+                opening = False
+                
+        if opening:
+            try:
+                db = self.open_tenant(tenant_id)
+            except BaseException as e:
+                # forget the tenant, so the next request tries again
+                with self.lock:
+                    del self.open[tenant_id]
+                entry[0].set_exception(e)
+                raise
+            entry[0].set_result(db)
+            with self.lock:
+                unused = self.close_unused()
+            self.close_tenants(unused)
+        return entry[0].result()
+
+    def release(self, tenant_id):
+        with self.lock:
+            self.open[tenant_id][1] -= 1
+            unused = []
+            if len(self.open) > self.max_open:
+                # more were open than allowed while they were all busy
+                unused = self.close_unused()
+        self.close_tenants(unused)
+
+    def open_tenant(self, tenant_id):
+        file_name = self.tenant_file(tenant_id)
+        if tenant_id not in self.seeded:
+            os.makedirs(self.tenant_dir, exist_ok=True)
+            # start from a new file, the backup API can't copy over a broken one
+            for old_file in (file_name, file_name + "-wal", file_name + "-shm"):
+                if os.path.exists(old_file):
+                    os.remove(old_file)
+            snapshot.restore(self.seed_file, file_name)
+            self.seeded.add(tenant_id)
+        try:
+            db = albumsdb.albumsDB(file_name, pool_size=self.pool_size, profiler=self.profiler)
+            db.connect()
+        except BaseException:
+            # copy the seed again next time, in case the copy is what's broken
+            self.seeded.discard(tenant_id)
+            raise
+        with self.lock:
+            self.opened += 1
+        return db
+
+    def close_unused(self):
+        """take least recently used tenants out of the open tenants until no 
+           more than max_open are open, and return them (tenant ID, albumsDB)
+           so they can be closed once the lock is released (see 
+           close_tenants). Tenants serving a request (or still being opened)
+           are skipped, so if they are all busy there can be more than 
+           max_open for a while. Call with the lock held.
+        """
+        unused = []
+        for tenant_id in list(self.open):
+            if len(self.open) <= self.max_open:
+                break
+            future, users = self.open[tenant_id]
+            if users == 0:
+                del self.open[tenant_id]
+                unused.append((tenant_id, future.result()))
+        return unused
+
+    def close_tenants(self, unused):
+        """close the tenants close_unused took out"""
+        for tenant_id, db in unused:
+            db.closeDB()
+            with self.lock:
+                self.closed += 1
+            if self.on_close is not None:
+                self.on_close(tenant_id)
+
+    def close(self):
+        """close every tenant"""
+        with self.lock:
+            for future, users in self.open.values():
+                if future.done() and future.exception() is None:
+                    future.result().closeDB()
+            self.open.clear()
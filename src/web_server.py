@@ -20,7 +20,7 @@
     GNU General Public License for more details.
     
     TO DO:
-        * Add search/next/prev and add/edit/delete capabilities to forms 
+        * Add add/edit/delete capabilities to forms 
         * Add some styling (especially buttons at top of pages)
         * Add an Order form?
         * Use match/case in place of the large if/elif constructs in do_GET and
@@ -34,17 +34,116 @@
 """
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
+import argparse
 import cgi
+import cProfile
+import csv
+import html
+import io
+import os
+import pstats
+import queue
 import re
+import selectors
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import functools
+import http.cookies
+import access_log
 import albumsdb
+import compression
+import metrics
+import page_cache
+import query_profiler
+import templates as template_cache
+import tenants
 
-# hardcoded global parameters
+# hardcoded global parameters (server_mode and worker_threads can be
+# overridden on the command line)
 hostname = "localhost"
 serverport = 9000
 database_file = r"..\database\albums.db"
+server_mode = "threaded"        # "threaded", "single" or "prefork"
+worker_threads = 8              # size of worker thread pool and db connection pool
+worker_processes = os.cpu_count() or 1     # number of processes in prefork mode
+page_cache_size = 256           # max number of rendered pages to keep
+keepalive_timeout = 5           # seconds before an idle keep-alive connection is closed
+streaming = True                # send pages as they are rendered (chunked)
+max_cached_page_size = 4 * 1024 * 1024     # bigger streamed pages aren't cached
+page_size = 50                  # rows per page of albums/artists/labels
+max_page_size = 500             # largest page a browser can ask for (size=)
+search_page_size = 20           # search results per page
+slow_query_ms = None            # log statements slower than this (None = no query profiling)
+profile_dir = r"..\profiles"    # where profiled requests (X-Profile: 1) are saved
+profile_top = 30                # functions listed in a profile summary
+snapshot_file = r"..\database\albums.snapshot.db"     # restored by POST /admin/reset, see snapshot.py
+max_tenants = 0                 # tenant databases kept open (0 = no tenant mode), see tenants.py
+tenant_dir = r"..\database\tenants"   # where the tenant databases are kept
+tenant_pool_size = 2            # db connections for each tenant
+access_log_file = "-"           # structured access log ("-" is stderr, None for no log)
+ 
+# html templates. Each one is read and compiled once (see templates.py) and 
+# only re-read if the file changes.
+templates = template_cache.TemplateCache({
+    "fake_login": r"..\html\fake_login.html",
+    "albums": r"..\html\albums.html",
+    "artists": r"..\html\artists.html",
+    "labels": r"..\html\labels.html",
+    "tracks": r"..\html\tracks.html",
+    "add_album_form": r"..\html\add_album_form.html",
+    "add_track_form": r"..\html\add_track_form.html",
+    "add_artist_form": r"..\html\add_artist_form.html",
+    "add_label_form": r"..\html\add_label_form.html",
+    "search": r"..\html\search.html",
+    "add_tracks_form": r"..\html\add_tracks_form.html",
+    "add_tracks_result": r"..\html\add_tracks_result.html",
+})
+ 
+# rendered pages, see page_cache.py
+pages = page_cache.PageCache(page_cache_size)
+
+# times database statements when slow_query_ms is set, see query_profiler.py
+profiler = None
+
+# each tenant's database in tenant mode (--tenants), see tenants.py
+tenant_dbs = None
+
+# written by a background thread, see access_log.py
+request_log = None
+
+# /t/<tenant>/rest-of-path
+tenant_prefix_re = re.compile(r"^/t/([^/?]*)(/.*)?$")
+
+# only one request is run under cProfile at a time
+request_profile_lock = threading.Lock()
+
+# page cache and compression counters, shown at /metrics with the rest
+metrics.registry.add(metrics.Callback("albumserver_page_cache_hits_total",
+    "Pages served from the page cache", "counter", lambda: pages.hits))
+metrics.registry.add(metrics.Callback("albumserver_page_cache_misses_total",
+    "Pages that had to be rendered", "counter", lambda: pages.misses))
+metrics.registry.add(metrics.Callback("albumserver_tenants_open",
+    "Tenant databases open (tenant mode)", "gauge",
+    lambda: 0 if tenant_dbs is None else len(tenant_dbs.open)))
+metrics.registry.add(metrics.Callback("albumserver_tenants_closed_total",
+    "Tenant databases closed to make room for others", "counter",
+    lambda: 0 if tenant_dbs is None else tenant_dbs.closed))
+metrics.registry.add(metrics.Callback("albumserver_page_cache_pages",
+    "Pages in the page cache", "gauge", lambda: len(pages.pages)))
+metrics.registry.add(metrics.Callback("albumserver_compressed_responses_total",
+    "Responses sent compressed", "counter", lambda: compression.stats.responses))
+metrics.registry.add(metrics.Callback("albumserver_compression_bytes_saved_total",
+    "Bytes saved by compressing responses", "counter", lambda: compression.stats.bytes_saved))
  
 # dynamically build list of links to add to each html page. This can be
-# done easily by using "replace {{links}}" in each method that builds
+# done easily by filling in the {{links}} slot in each method that builds
 # an html page from a template. Is there a better place to put this list?
 # Can't put in MyServer because MyServer is never instantiated.
 base = hostname + ":" + str(serverport) + "/"  
@@ -53,18 +152,476 @@ links = ("<a href=http://" + base + "albums>Albums</a>\n"
          "<a href=http://" + base + "labels>Labels</a>\n" +
          "<a href=http://" + base + "add_album>Add Album</a>\n" +
          "<a href=http://" + base + "add_track>Add Track</a>\n" +
+         "<a href=http://" + base + "add_tracks>Add Tracks</a>\n" +
          "<a href=http://" + base + "add_artist>Add Artist</a>\n" +
          "<a href=http://" + base + "add_label>Add Label</a>\n" +
-         "<a href=http://" + base + ">Logout</a>")
+         "<a href=http://" + base + "search>Search</a>\n" +
+         "<a href=http://" + base + ">Logout</a>").encode("utf-8")
+
+# tracks page only gets 2 links
+track_links = ("<a href=http://" + base + "albums>Back</a>\n"
+               "<a href=http://" + base + ">Logout</a>\n").encode("utf-8")
+        
+baseURL = "http://" + hostname + ":" + str(serverport)
+
+# Formatting for a single database row. Pages are built by mapping these over
+# the rows from the database, see MyServer.albums_page etc.
+
+def album_row(data):
+    """table row for one album: albumID, title, artist, year, label, price"""
+    # embed albumID in URL so tracks know which album 
+    return ("<tr><td><input type='checkbox' onclick='Add2Total()' id='buyme'></td>" +
+            "<td><a href=" + baseURL + "/tracks?ID=" + str(data[0]) + ">" + data[1] + "</a></td>" +
+            "<td>" + data[2] + "</td><td>" + str(data[3]) + "</td>" +
+            "<td>" + data[4] + "</td><td>" + str(data[5]) + "</td></tr>")
+
+def artist_row(data):
+    """table row for one artist: artist | city | state
+       (skip data[0] as this is the artistID)
+    """
+    return "<tr><td>" + data[1] + "</td><td>" + data[2] + "</td><td>" + data[3] + "</td></tr>"
+
+def label_row(data):
+    """table row for one record label (skip data[0] as this is the record_labelID)"""
+    return "<tr><td>" + data[1] + "</td></tr>"
+
+def track_row(data):
+    """table row for one track: track number | title | length"""
+    # data[0] is an int so convert it to string
+    return "<tr><td>" + str(data[0]) + "</td><td>" + data[1] + "</td><td>" + str(data[2]) + "</td></tr>"
+
+def search_row(data):
+    """table row for one search result: kind | name. Albums and tracks link 
+       to the album's track list.
+    """
+    kind, ID, title, albumID = data
+    if kind == 0:
+        albumID = ID
+    if albumID is not None:
+        title = "<a href=" + baseURL + "/tracks?ID=" + str(albumID) + ">" + title + "</a>"
+    return "<tr><td>" + albumsdb.search_kinds[kind] + "</td><td>" + title + "</td></tr>"
+
+def error_row(data):
+    """table row for one bulk load error: row | error"""
+    return f"<tr><td>{html.escape(data[0])}</td><td>{html.escape(data[1])}</td></tr>\n"
+
+def tracks_form_rows(form):
+    """Generate the track rows sent by the add tracks form, as (row name,
+       [albumRef, track num, track title, length]). First the rows typed into
+       the form (rows with no title are skipped), then the rows of the
+       uploaded csv file, if there is one. If the file can't be read as csv 
+       (eg it isn't UTF-8 text) the last row is (row name, error message) 
+       and the rest of the file is skipped.
+       
+       Parameters:
+       form: cgi.FieldStorage of the form
+    """
+    titles = form.getlist("track_title")
+    nums = form.getlist("track_num")
+    lengths = form.getlist("track_length")
+    album_ids = form.getlist("albumID")
+    for i, title in enumerate(titles):
+        if not title.strip():
+            continue
+        # one album for every row, or an album for each row
+        album = album_ids[i] if len(album_ids) > i else (album_ids[0] if album_ids else "")
+        yield ("form row " + str(i + 1),
+               [album, nums[i] if i < len(nums) else "", title,
+                lengths[i] if i < len(lengths) else ""])
+        
+    upload = form["tracks_csv"] if "tracks_csv" in form else None
+    if upload is not None and upload.file is not None and upload.filename:
+        reader = csv.reader(io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline=""))
+        while True:
+            try:
+                fields = next(reader, None)
+            except UnicodeDecodeError:
+                # the file is decoded a block at a time, so the bad bytes are 
+                # somewhere after the last line read
+                if reader.line_num:
+                    yield ("csv file", "not UTF-8 text after line " + str(reader.line_num) +
+                           ", the rest of the file was not read")
+                else:
+                    yield ("csv file", "not UTF-8 text, the file was not read")
+                return
+            except csv.Error as e:
+                yield ("csv line " + str(reader.line_num), 
+                       "not a valid csv line (" + str(e) + "), the rest of the file was not read")
+                return
+            if fields is None:
+                break
+            # skip blank lines and the header line
+            if not fields or (reader.line_num == 1 and fields[0].strip().lower() == "albumref"):
+                continue
+            yield ("csv line " + str(reader.line_num), fields)
+
+def menu_option(data):
+    """menu option for a form, eg: <option value=1>Santana</option>
+       data[0] is the ID and data[1] the name
+    """
+    return "<option value=" + str(data[0]) + ">" + data[1] + "</option>"
+
+# Paging for the albums, artists and labels lists. The query string can have
+# sort (eg albums?sort=year), dir=desc, size (rows per page) and after/before
+# (ID of the row the next page starts after, or the previous page ends before)
+
+album_sort_names = {"title": "Title", "artist": "Artist", "year": "Year", "price": "Price"}
+
+def page_request(path, sorts, default_sort):
+    """read the paging parameters from path's query string. Anything invalid
+       is replaced by the default.
+    
+       Parameters:
+       path: request path, eg "/albums?sort=year&after=12"
+       sorts: valid sort names
+       default_sort: sort to use if there isn't a valid one in the path
+       
+       Returns: dictionary of albumsDB.get_*_page parameters
+    """
+    query = parse_qs(urlsplit(path).query)
+    
+    def first(name):
+        values = query.get(name)
+        return values[0] if values else None
+    
+    def number(name):
+        value = first(name)
+        return int(value) if value is not None and value.isdigit() else None
+    
+    sort = first("sort")
+    if sort not in sorts:
+        sort = default_sort
+    size = number("size") or page_size
+    return {"sort": sort,
+            "descending": first("dir") == "desc",
+            "after": number("after"),
+            "before": number("before"),
+            "page_size": max(1, min(size, max_page_size))}
+
+def page_query(paging, **changes):
+    """query string for a page link: the current sort and page size, with
+       changes applied (eg after=12)
+    """
+    params = {"sort": paging["sort"]}
+    if paging["descending"]:
+        params["dir"] = "desc"
+    if paging["page_size"] != page_size:
+        params["size"] = paging["page_size"]
+    params.update(changes)
+    return urlencode({name: value for name, value in params.items() if value is not None})
+
+def paged_route(route, paging):
+    """page cache key for one page of a list"""
+    return route + "?" + page_query(paging, after=paging["after"], before=paging["before"])
+
+def pager_links(route, paging, rows, has_prev, has_next):
+    """Prev and Next links for a page of rows (first column is the row ID)"""
+    pager = []
+    if has_prev and rows:
+        pager.append("<a id='prev_page' href='" + baseURL + route + "?" + 
+                     page_query(paging, before=rows[0][0]) + "'>Prev</a>")
+    if has_next and rows:
+        pager.append("<a id='next_page' href='" + baseURL + route + "?" + 
+                     page_query(paging, after=rows[-1][0]) + "'>Next</a>")
+    return "\n".join(pager)
+
+def sort_links(route, paging, sort_names):
+    """Sort by: links, back to the first page. Clicking the current sort 
+       reverses it.
+    """
+    sort_by = []
+    for sort, name in sort_names.items():
+        params = {"sort": sort}
+        if sort == paging["sort"]:
+            name += " (desc)" if paging["descending"] else " (asc)"
+            if not paging["descending"]:
+                params["dir"] = "desc"
+        sort_by.append("<a id='sort_" + sort + "' href='" + baseURL + route + "?" + 
+                       urlencode(params) + "'>" + name + "</a>")
+    return "Sort by: " + " | ".join(sort_by)
+
+def tenant_database(handler_method):
+    """Decorator for do_GET/do_POST: picks the database the request uses
+       (self.db). In tenant mode a request for a tenant (see 
+       MyServer.tenant_id) uses the tenant's own database, every other 
+       request uses my_albumsdb. Goes inside measured, so requests refused
+       here are still counted and logged.
+    """
+    @functools.wraps(handler_method)
+    def wrapper(self):
+        self.tenant = None
+        self.tenant_cookie = None
+        self.db = my_albumsdb
+        tenant = None if tenant_dbs is None else self.tenant_id()
+        if tenant is None:
+            handler_method(self)
+            return
+        if not tenants.valid_tenant_id(tenant):
+            self.send_error(400, "Bad tenant name", 
+                            "Tenant names can only have letters, digits, - and _")
+            return
+        try:
+            self.db = tenant_dbs.acquire(tenant)
+        except (OSError, sqlite3.Error) as e:
+            print("Unable to open the database for tenant " + tenant + ": " + str(e))
+            self.send_error(503, "Tenant database not available", str(e))
+            return
+        self.tenant = tenant
+        try:
+            handler_method(self)
+        finally:
+            tenant_dbs.release(tenant)
+    return wrapper
+
+def measured(handler_method):
+    """Decorator for do_GET/do_POST: records the request's route, status
+       code, response size and how long it took (see metrics.py), and 
+       writes it to the access log
+    """
+    @functools.wraps(handler_method)
+    def wrapper(self):
+        self.status_code = 500          # if the handler dies before responding
+        self.response_bytes = 0
+        self.cache_status = None
+        arrived = time.time()
+        start = time.perf_counter()
+        try:
+            handler_method(self)
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.record_request(self.command, self.path, self.status_code,
+                                   seconds, self.response_bytes)
+            if request_log is not None:
+                request_log.record(arrived, self.client_address[0], self.command, self.path,
+                                   getattr(self, "tenant", None), self.status_code,
+                                   self.response_bytes, seconds, self.cache_status)
+    return wrapper
+
+def profiled(handler_method):
+    """Decorator for do_GET/do_POST: runs the request under cProfile if the
+       browser asked for it, see MyServer.profile_mode
+    """
+    @functools.wraps(handler_method)
+    def wrapper(self):
+        mode = self.profile_mode()
+        if mode is None:
+            handler_method(self)
+        elif not request_profile_lock.acquire(blocking=False):
+            print("Another request is being profiled, not profiling " + self.path)
+            handler_method(self)
+        else:
+            try:
+                self.run_profiled(handler_method, mode)
+            finally:
+                request_profile_lock.release()
+    return wrapper
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that hands each request to a fixed size pool of worker
+       threads, so a slow client or a long page render only ties up one
+       worker instead of the whole server. Requests that arrive while every
+       worker is busy wait in the executor's queue.
+       
+       Workers never sit waiting for a client to send a request. New
+       connections, and keep-alive connections between requests, are parked
+       in a selector watched by one thread (see watch_parked), and only handed
+       to a worker once the client has sent something. A parked connection
+       that stays idle for the handler's timeout is closed.
+       
+       Parameters:
+       server_address: (hostname, port) tuple
+       handler_class: request handler class (MyServer)
+       workers: number of worker threads
+    """
+    
+    # allow a backlog of connections while the workers are busy
+    request_queue_size = 128
+    # seconds between checks for parked connections that have been idle too long
+    idle_check_interval = 0.5
+    
+    def __init__(self, server_address, handler_class, workers):
+        # before HTTPServer.__init__, which calls server_close if it can't bind
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="worker")
+        # set up by serve_forever, so in prefork mode each worker process 
+        # has its own
+        self.parking = None
+        self.parking_thread = None
+        self.stopping = False
+        super().__init__(server_address, handler_class)
+        
+    def serve_forever(self, poll_interval=0.5):
+        """start the thread that watches the parked connections, then serve"""
+        self.parking = queue.SimpleQueue()      # (connection, client address) to park
+        self.wakeup_receive, self.wakeup_send = socket.socketpair()
+        self.wakeup_send.setblocking(False)
+        self.parking_thread = threading.Thread(target=self.watch_parked, name="keepalive",
+                                               daemon=True)
+        self.parking_thread.start()
+        super().serve_forever(poll_interval)
+        
+    def process_request(self, request, client_address):
+        """park a new connection until the client sends its request"""
+        self.park(request, client_address)
+        
+    def park(self, request, client_address):
+        """hand a connection to the parking thread to wait for its next request"""
+        self.parking.put((request, client_address))
+        self.wake_parking_thread()
+        
+    def wake_parking_thread(self):
+        try:
+            self.wakeup_send.send(b"x")
+        except BlockingIOError:
+            pass                # it has plenty of wake ups waiting already
+        
+    def process_request_thread(self, request, client_address):
+        """runs in a worker thread: handle the request(s) the client has sent,
+           then park the connection again if it is being kept open
+        """
+        try:
+            handler = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        if handler.close_connection or self.stopping:
+            self.shutdown_request(request)
+        else:
+            self.park(request, client_address)
+            
+    def finish_request(self, request, client_address):
+        """handle the waiting request(s), see MyServer.handle
+        
+           Returns: the request handler
+        """
+        return self.RequestHandlerClass(request, client_address, self)
+        
+    def watch_parked(self):
+        """Runs in the parking thread. Connections the client has sent
+           something on are queued for the workers, connections that have been
+           idle for longer than the handler's timeout are closed.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_receive, selectors.EVENT_READ)
+        parked = {}             # connection: (client address, time parked), oldest first
+        timeout = self.RequestHandlerClass.timeout
+        while not self.stopping:
+            for key, events in selector.select(self.idle_check_interval):
+                if key.fileobj is self.wakeup_receive:
+                    self.wakeup_receive.recv(4096)
+                    continue
+                selector.unregister(key.fileobj)
+                client_address, parked_time = parked.pop(key.fileobj)
+                self.executor.submit(self.process_request_thread, key.fileobj, client_address)
+            while True:
+                try:
+                    request, client_address = self.parking.get_nowait()
+                except queue.Empty:
+                    break
+                selector.register(request, selectors.EVENT_READ)
+                parked[request] = (client_address, time.monotonic())
+            
+            if timeout is not None:
+                now = time.monotonic()
+                expired = []
+                for request, (client_address, parked_time) in parked.items():
+                    if now - parked_time <= timeout:
+                        break
+                    expired.append(request)
+                for request in expired:
+                    selector.unregister(request)
+                    del parked[request]
+                    self.shutdown_request(request)
+                    
+        for request in parked:
+            self.shutdown_request(request)
+        selector.close()
+        
+    def server_close(self):
+        super().server_close()
+        self.stopping = True
+        if self.parking_thread is not None:
+            self.wake_parking_thread()
+            self.parking_thread.join()
+        self.executor.shutdown(wait=True)
+        if self.parking is not None:
+            # parked by a worker after the parking thread stopped
+            while True:
+                try:
+                    request, client_address = self.parking.get_nowait()
+                except queue.Empty:
+                    break
+                self.shutdown_request(request)
+            self.wakeup_receive.close()
+            self.wakeup_send.close()
         
 class MyServer(BaseHTTPRequestHandler):
+    """Request handler. Speaks HTTP/1.1, so browsers and load generators can
+       send many requests over one connection. Every response carries a
+       Content-Length (or is a 304) so the client knows where it ends. A
+       connection that sits idle for timeout seconds is closed.
+    """
+    
+    protocol_version = "HTTP/1.1"
+    timeout = keepalive_timeout
+    skip_page_cache = False         # True to always render (profiled requests)
+    # the headers and the body are written separately. With Nagle's algorithm
+    # on, the body waits for the client to ack the headers, which costs ~40ms
+    # per response on a keep-alive connection
+    disable_nagle_algorithm = True
+    tenant_cookie = None            # tenant to set the cookie for, see tenant_id
     
+    def handle(self):
+        """Handle the requests the client has sent so far. Unlike http.server
+           this doesn't wait for the next request on a keep-alive connection:
+           the connection goes back to the server, which parks it until the
+           client sends something (see PooledHTTPServer). A request that has 
+           already arrived (eg pipelined) is handled straight away, as it may
+           be sitting in rfile's buffer where the server can't see it.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.request_waiting():
+            self.handle_one_request()
+            
+    def request_waiting(self):
+        """True if (part of) another request has already arrived. Doesn't 
+           wait for one.
+        """
+        self.connection.settimeout(0)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def parse_request(self):
+        """http.server's parse_request, but a request body sent with
+           Transfer-Encoding (eg chunked) is refused with 411 Length Required.
+           The body is only read by Content-Length, so the rest of it would
+           be taken for the next request on the connection. Browsers always
+           send a Content-Length with a form.
+        """
+        if not super().parse_request():
+            return False
+        if self.headers.get("Transfer-Encoding", "identity").strip().lower() != "identity":
+            # send_error closes the connection, so the body is never read
+            self.send_error(411, "Length Required",
+                            "Send the request body with a Content-Length, not Transfer-Encoding")
+            return False
+        return True
+    
+    @measured
+    @tenant_database
+    @profiled
     def do_GET(self):
         """determine where to go when user clicks a link"""
         
         # replace if/elif with match/case?
         if (self.path == "/"):   
-            self.display_unmodified_form(r"..\html\fake_login.html")
+            self.display_unmodified_form("fake_login")
         elif ("/albums" in self.path):
             self.get_albums()
         elif ("/artists" in self.path):
@@ -74,133 +631,500 @@ class MyServer(BaseHTTPRequestHandler):
         elif ("/tracks" in self.path):
             # albumID is after the ? in path eg "tracks?ID=4"
             match = re.search('\d+$', self.path)
+            if match is None:
+                self.send_error(404, "Album ID missing")
+                return
             albumID = match.group()
             self.get_tracks(albumID)
         elif ("/add_album" in self.path):
             self.put_album_form()
         elif ("/add_artist" in self.path):
-            self.display_unmodified_form(r"..\html\add_artist_form.html")
+            self.display_unmodified_form("add_artist_form")
+        elif ("/add_tracks" in self.path):
+            self.put_tracks_form()
         elif ("/add_track" in self.path):
             self.put_track_form()
         elif ("/add_label" in self.path):
-            self.display_unmodified_form(r"..\html\add_label_form.html")
+            self.display_unmodified_form("add_label_form")
+        elif ("/search" in self.path):
+            self.get_search()
+        elif self.path == "/metrics":
+            self.get_metrics()
+        elif self.path == "/query_report" and profiler is not None:
+            self.get_query_report()
+        else:
+            self.send_error(404)
     
+    @measured
+    @tenant_database
+    @profiled
     def do_POST(self):
         """determine what to do when user clicks a submit button on a form"""
-        ctype, pdict = cgi.parse_header(self.headers.get('content-type'))
+        if self.path == '/admin/reset':
+            # no form, so checked before the content type
+            self.admin_reset()
+            return
+        ctype, pdict = cgi.parse_header(self.headers.get('content-type', ''))
+        if ctype != 'multipart/form-data':
+            self.send_error(415, "Forms must be sent as multipart/form-data")
+            return
+        if self.path == '/add_tracks':
+            # reads the form itself, a file at a time
+            self.add_tracks()
+            return
         pdict['boundary'] = bytes(pdict['boundary'], 'utf-8')
-        if ctype == 'multipart/form-data':
-            fields = cgi.parse_multipart(self.rfile, pdict)
+        # on a keep-alive connection the next request follows the form data, 
+        # so tell cgi where the form data ends
+        pdict['CONTENT-LENGTH'] = self.headers.get('content-length', '0')
+        fields = cgi.parse_multipart(self.rfile, pdict)
         
         if self.path == '/add_album':
-            my_albumsdb.add_album(fields)
+            self.db.add_album(fields)
             self.get_albums()
         elif self.path == '/add_track':
-            my_albumsdb.add_track(fields)
+            self.db.add_track(fields)
             self.put_track_form()
         elif self.path == '/add_artist':
-            my_albumsdb.add_artist(fields)
+            self.db.add_artist(fields)
             self.get_artists()
         elif self.path == '/add_label':
-            my_albumsdb.add_label(fields)
+            self.db.add_label(fields)
             self.get_labels()
+        else:
+            self.send_error(404)
         
-    def get_albums(self):
-        """retrieve a list of albums from database and display the list"""
-        # get template
+    def tenant_id(self):
+        """Which tenant is the request for (tenant mode)? The first of:
+           
+             * a /t/<tenant> prefix on the path, eg /t/worker1/albums. The 
+               prefix is removed, and the response sets the tenant cookie so 
+               the links on the page stay with the tenant.
+             * the header "X-Tenant: <tenant>"
+             * the tenant cookie
+           
+           Returns: the tenant name or None (no tenant)
+        """
+        match = tenant_prefix_re.match(self.path)
+        if match is not None:
+            self.path = match.group(2) or "/"
+            if tenants.valid_tenant_id(match.group(1)):
+                self.tenant_cookie = match.group(1)
+            return match.group(1)
+        tenant = self.headers.get("X-Tenant")
+        if tenant is not None:
+            return tenant.strip()
         try:
-            with open(r"..\html\albums.html") as f:
-                file = f.read()
-        except Exception as e:
-            print(e)
-            self.send_response(500, "Failed")
+            cookie = http.cookies.SimpleCookie(self.headers.get("Cookie", "")).get("tenant")
+        except http.cookies.CookieError:
+            return None
+        return None if cookie is None else cookie.value
+    
+    def end_headers(self):
+        """add the tenant cookie to the headers if the request had a /t/<tenant> prefix"""
+        if self.tenant_cookie is not None:
+            self.send_header("Set-Cookie", "tenant=" + self.tenant_cookie + "; Path=/; SameSite=Strict")
+            self.tenant_cookie = None
+        super().end_headers()
+        
+    def profile_mode(self):
+        """Did the browser ask for this request to be profiled? Either with
+           the header "X-Profile: 1" or with "__profile=1" in the query string.
+           Use "summary" instead of 1 to get the profile back in place of the
+           page. Only requests from this computer can be profiled.
+           
+           Returns: "1", "summary" or None (don't profile)
+        """
+        value = self.headers.get("X-Profile")
+        if "__profile=" in self.path:
+            # take it out of the path, so the request is routed (and cached)
+            # exactly as it would be without it
+            parts = urlsplit(self.path)
+            query = parse_qsl(parts.query, keep_blank_values=True)
+            for name, query_value in query:
+                if name == "__profile":
+                    value = value or query_value
+            query = [(name, query_value) for name, query_value in query if name != "__profile"]
+            self.path = urlunsplit(parts._replace(query=urlencode(query)))
+        
+        if value not in ("1", "summary"):
+            return None
+        if self.client_address[0] not in ("127.0.0.1", "::1"):
+            print("Profiling refused for " + self.client_address[0])
+            return None
+        return value
+    
+    def run_profiled(self, handler_method, mode):
+        """Run handler_method under cProfile and save the profile in
+           profile_dir, named by method, route and time. The page is always
+           rendered, not taken from the page cache. In "summary" mode the
+           browser gets the top functions instead of the page.
+        """
+        profile = cProfile.Profile()
+        self.skip_page_cache = True
+        if mode == "summary":
+            browser = self.wfile
+            self.wfile = io.BytesIO()        # the page is thrown away
+        try:
+            profile.runcall(handler_method, self)
+        finally:
+            if mode == "summary":
+                self.wfile = browser
+        
+        # eg GET-albums-20220714-153012.345.pstats
+        route = metrics.route_name(self.path).strip("/") or "root"
+        now = time.time()
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f".{int(now * 1000) % 1000:03d}"
+        file_name = os.path.join(profile_dir, f"{self.command}-{route}-{timestamp}.pstats")
+        os.makedirs(profile_dir, exist_ok=True)
+        profile.dump_stats(file_name)
+        print("Profile of " + self.command + " " + self.path + " saved to " + file_name)
+        
+        if mode == "summary":
+            summary = io.StringIO()
+            summary.write(f"{self.command} {self.path}\nProfile saved to {file_name}\n\n")
+            pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(profile_top)
+            body = summary.getvalue().encode("utf-8")
+            self.send_response(200, "OK")
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+    def log_request(self, code="-", size="-"):
+        """requests are logged by the measured decorator instead"""
+        
+    def log_message(self, format, *args):
+        """http.server's messages (eg errors) go to stderr from the access 
+           log's thread, so the request doesn't wait for the console
+        """
+        if request_log is None:
+            super().log_message(format, *args)
+            return
+        request_log.message(f"{self.address_string()} - - [{self.log_date_time_string()}] "
+                            f"{format % args}")
+        
+    def send_response(self, code, message=None):
+        """remember the status code for the metrics"""
+        self.status_code = code
+        super().send_response(code, message)
+        
+    def send_header(self, keyword, value):
+        """remember the body size for the metrics (streamed pages are
+           counted in write_chunk)
+        """
+        if keyword == "Content-Length":
+            self.response_bytes = int(value)
+        super().send_header(keyword, value)
+        
+    def send_page(self, page):
+        """send a rendered page_cache.Page to the browser, compressed if the
+           browser accepts it, or just a 304 Not Modified if the browser already
+           has this version of the page
+        """
+        encoding = compression.choose_encoding(self.headers.get("Accept-Encoding"), 
+                                               len(page.body))
+        body, etag = page.variant(encoding)
+        
+        if self.not_modified(page, etag):
+            self.send_response(304, "Not Modified")
+            self.send_validators(page, etag)
             self.end_headers()
-            self.wfile.write(bytes(e, "utf-8"))
             return
         
-        # format album data from database
-        table_data = my_albumsdb.get_albums()
-        table_row = ""
-        baseURL = "http://" + hostname + ":" + str(serverport)
-        for data in table_data:
-            albumID = str(data[0])
-            album_title = data[1]
-            artist_name = data[2]
-            year = str(data[3])
-            label_name = data[4]
-            price = str(data[5])
-            
-            table_row += "<tr><td><input type='checkbox' onclick='Add2Total()' id='buyme'></td>"
-            
-            # embed albumID in URL so tracks know which album 
-            table_row += ("<td><a href=" + baseURL + "/tracks?ID=" + albumID + ">" + album_title + "</a></td>" +
-                         "<td>" + artist_name + "</td><td>" + year + "</td>" +
-                         "<td>" + label_name + "</td><td>" + price + "</td></tr>")
-    
-        # add links to top of page
-        file = file.replace("{{links}}", links)
-        # replace {{db_records}} in template by table_row
-        file = file.replace("{{db_records}}", table_row)
         self.send_response(200, "OK")
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if encoding != "identity":
+            self.send_header("Content-Encoding", encoding)
+            compression.stats.record(len(page.body), len(body))
+        self.send_header("Content-Length", str(len(body)))
+        self.send_validators(page, etag)
         self.end_headers()
-        self.wfile.write(bytes(file, "utf-8"))
+        self.wfile.write(body)
         
-    def get_artists(self):
-        """retrieve list of artists from database and display the list"""
-        # get template
+    def send_validators(self, page, etag):
+        """send the ETag and Last-Modified headers for page (a Page or
+           page_cache.Validators). no-cache tells the browser to check with us
+           (conditional GET) before reusing it. The page depends on
+           Accept-Encoding, so say so for any caches.
+        """
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", page.last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        
+    def not_modified(self, page, etag):
+        """True if the request's If-None-Match/If-Modified-Since headers show
+           the browser already has page. If-None-Match wins if both are sent.
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            if if_none_match.strip() == "*":
+                return True
+            # weak validators (W/"...") match too - same page either way
+            etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+            return etag in etags
+        
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return page.modified_time <= since
+        return False
+        
+    def send_cached_page(self, route, template_name, page_values, *args):
+        """send the page for route from the page cache. If it isn't cached, or
+           the database or template changed since it was cached, build it: 
+           either streamed to the browser as it is rendered (streaming on) or
+           rendered in full first.
+        
+           Parameters:
+           route: cache key, eg "/albums" or "/tracks?ID=4"
+           template_name: name of the page's template
+           page_values: method that returns the template's slot values: 
+                        page_values(*args). Table rows can be generators.
+        """
         try:
-            with open(r"..\html\artists.html") as f:
-                file = f.read()
-        except Exception as e:
-            print(e)
-            self.send_response(500, "Failed")
+            template = templates.get(template_name)
+        except OSError as e:
+            self.send_template_error(e)
+            return
+        
+        # read the version before rendering, so a page that races with a 
+        # write is never cached under the newer version
+        version = (self.db.data_generation(), template.version)
+        if self.tenant is not None:
+            # each tenant has its own pages
+            route = "/t/" + self.tenant + route
+        page = None if self.skip_page_cache else pages.get(route, version)
+        if self.skip_page_cache:
+            self.cache_status = "skip"
+        else:
+            self.cache_status = "miss" if page is None else "hit"
+        if page is not None:
+            self.send_page(page)
+        elif streaming:
+            data_token, data_time = self.db.data_stamp()
+            validators = page_cache.version_validators(
+                data_token, route, template.version, max(data_time, template.mtime / 1e9))
+            self.send_streamed_page(route, version, template, validators, page_values, args)
+        else:
+            page = page_cache.Page(template.render(**page_values(*args)))
+            pages.put(route, version, page)
+            self.send_page(page)
+            
+    def send_streamed_page(self, route, version, template, validators, page_values, args):
+        """render the page a chunk at a time and send each chunk as soon as it
+           is ready (chunked transfer encoding), so the first bytes go out right
+           away and memory use doesn't grow with the size of the table. If the
+           page turns out to be no bigger than max_cached_page_size it is also
+           put in the page cache. If the browser already has this version of
+           the page it just gets a 304 Not Modified, without rendering.
+        
+           Parameters:
+           route, version: page cache key and version
+           template: compiled template
+           validators: page_cache.Validators for this version of the page
+           page_values, args: page_values(*args) returns the template's slot values
+        """
+        # size isn't known yet, assume the page is big enough to compress
+        encoding = compression.choose_encoding(self.headers.get("Accept-Encoding"),
+                                               compression.min_size)
+        etag = validators.encoding_etag(encoding)
+        if self.not_modified(validators, etag):
+            self.send_response(304, "Not Modified")
+            self.send_validators(validators, etag)
             self.end_headers()
-            self.wfile.write(bytes(e, "utf-8"))
             return
         
-        # format artist data from database
-        table_data = my_albumsdb.get_artists()
-        table_row = ""
-        for data in table_data:
-            # row should look like: artist | origin
-            # skip data[0] as this is the artistID
-            table_row += "<tr><td>" + data[1] + "</td><td>" + data[2] + "</td><td>" + data[3] + "</td></tr>"
-       
-        # add links to top of page
-        file = file.replace("{{links}}", links)
-        # replace {{db_records}} in template by table_row
-        file = file.replace("{{db_records}}", table_row)
+        values = page_values(*args)
+        compressor = compression.compressor(encoding)
+        # HTTP/1.0 clients don't understand chunks, the end of the page is
+        # marked by closing the connection instead
+        chunked = self.request_version == "HTTP/1.1"
+        
         self.send_response(200, "OK")
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if compressor is not None:
+            self.send_header("Content-Encoding", encoding)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        self.send_validators(validators, etag)
         self.end_headers()
-        self.wfile.write(bytes(file, "utf-8"))
-    
-    def get_labels(self):
-        """retrieve list of record labels from database and display the list"""
-        # get template
+        
+        page_chunks = []
+        page_size = 0
+        sent_size = 0
+        chunks = template.stream(**values)
         try:
-            with open(r"..\html\labels.html") as f:
-                file = f.read()
-        except Exception as e:
-            print(e)
-            self.send_response(500, "Failed")
-            self.end_headers()
-            self.wfile.write(bytes(e, "utf-8"))
+            for chunk in chunks:
+                if page_chunks is not None:
+                    page_chunks.append(chunk)
+                    page_size += len(chunk)
+                    if page_size > max_cached_page_size:
+                        page_chunks = None
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                sent_size += len(chunk)
+                self.write_chunk(chunk, chunked)
+            if compressor is not None:
+                chunk = compressor.flush()
+                sent_size += len(chunk)
+                self.write_chunk(chunk, chunked)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        finally:
+            # give the database connection back if the browser went away
+            chunks.close()
+            
+        if compressor is not None:
+            compression.stats.record(page_size, sent_size)
+        if page_chunks is not None:
+            pages.put(route, version, page_cache.Page(b"".join(page_chunks), validators))
+            
+    def write_chunk(self, data, chunked):
+        """send part of a streamed page"""
+        if not data:
+            # an empty chunk would mark the end of the page
             return
+        self.response_bytes += len(data)
+        if chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
         
-        # format record labels data from database
-        table_data = my_albumsdb.get_labels()
-        table_row = ""
-        for data in table_data:
-            # skip data[0] as this is the record_lableID
-            table_row += "<tr><td>" + data[1] + "</td></tr>"
-            
-        # add links to top of page
-        file = file.replace("{{links}}", links)
-        # replace {{db_records}} in template by table_row
-        file = file.replace("{{db_records}}", table_row)
+    def send_template_error(self, e):
+        """template could not be read - tell the browser"""
+        print(e)
+        message = bytes(str(e), "utf-8")
+        self.send_response(500, "Failed")
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+        
+    def get_metrics(self):
+        """request counts, latencies etc in Prometheus text format. Never
+           cached or compressed.
+        """
+        body = metrics.registry.render().encode("utf-8")
+        self.send_response(200, "OK")
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def get_query_report(self):
+        """the statements that took the most time, see query_profiler.py"""
+        body = profiler.report().encode("utf-8")
         self.send_response(200, "OK")
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(bytes(file, "utf-8"))
+        self.wfile.write(body)
+        
+    def admin_reset(self):
+        """Restore the database from snapshot_file (see snapshot.py), eg
+           between test runs. Only allowed from this computer.
+        """
+        if self.client_address[0] not in ("127.0.0.1", "::1"):
+            print("Reset refused for " + self.client_address[0])
+            self.send_error(403)
+            return
+        start = time.perf_counter()
+        try:
+            self.db.restore(snapshot_file)
+        except FileNotFoundError:
+            self.send_error(409, "No snapshot to restore",
+                            snapshot_file + " not found. Save one first with: python snapshot.py save")
+            return
+        except sqlite3.Error as e:
+            self.send_error(500, "Restore failed", str(e))
+            return
+        message = f"Restored {snapshot_file} in {(time.perf_counter() - start) * 1000:.1f} ms"
+        print(message)
+        body = (message + "\n").encode("utf-8")
+        self.send_response(200, "OK")
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def get_albums(self):
+        """retrieve a page of albums from database and display the list"""
+        paging = page_request(self.path, albumsdb.album_sorts, "title")
+        self.send_cached_page(paged_route("/albums", paging), "albums", 
+                              self.albums_page, paging)
+        
+    def albums_page(self, paging):
+        """slot values for the albums template: links at top of page, sort 
+           links, {{db_records}} filled in with one table row per album and 
+           next/prev links
+        """
+        rows, has_prev, has_next = self.db.get_albums_page(**paging)
+        return {"links": links, 
+                "sort_links": sort_links("/albums", paging, album_sort_names),
+                "db_records": map(album_row, rows),
+                "pager": pager_links("/albums", paging, rows, has_prev, has_next)}
+        
+    def get_artists(self):
+        """retrieve a page of artists from database and display the list"""
+        paging = page_request(self.path, albumsdb.artist_sorts, "name")
+        self.send_cached_page(paged_route("/artists", paging), "artists", 
+                              self.artists_page, paging)
+        
+    def artists_page(self, paging):
+        """slot values for the artists template"""
+        rows, has_prev, has_next = self.db.get_artists_page(**paging)
+        return {"links": links, 
+                "db_records": map(artist_row, rows),
+                "pager": pager_links("/artists", paging, rows, has_prev, has_next)}
+    
+    def get_labels(self):
+        """retrieve a page of record labels from database and display the list"""
+        paging = page_request(self.path, albumsdb.label_sorts, "name")
+        self.send_cached_page(paged_route("/labels", paging), "labels", 
+                              self.labels_page, paging)
+        
+    def labels_page(self, paging):
+        """slot values for the record labels template"""
+        rows, has_prev, has_next = self.db.get_labels_page(**paging)
+        return {"links": links, 
+                "db_records": map(label_row, rows),
+                "pager": pager_links("/labels", paging, rows, has_prev, has_next)}
+        
+    def get_search(self):
+        """full text search of albums, artists, labels and tracks (search?q=)"""
+        query = parse_qs(urlsplit(self.path).query)
+        text = query.get("q", [""])[0]
+        page = query.get("page", ["1"])[0]
+        page = int(page) if page.isdigit() and int(page) > 0 else 1
+        route = "/search?" + urlencode({"q": text, "page": page})
+        self.send_cached_page(route, "search", self.search_page, text, page)
+        
+    def search_page(self, text, page):
+        """slot values for the search template: the search form, one row per
+           result and next/prev links
+        """
+        rows, has_next = self.db.search(text, page, search_page_size)
+        pager = []
+        if page > 1:
+            pager.append("<a id='prev_page' href='" + baseURL + "/search?" + 
+                         urlencode({"q": text, "page": page - 1}) + "'>Prev</a>")
+        if has_next:
+            pager.append("<a id='next_page' href='" + baseURL + "/search?" + 
+                         urlencode({"q": text, "page": page + 1}) + "'>Next</a>")
+        return {"links": links,
+                "search_text": html.escape(text),
+                "db_records": map(search_row, rows),
+                "pager": "\n".join(pager)}
         
     def get_tracks(self, albumID):
         """retrieve list of album tracks for selected album from database and
@@ -208,136 +1132,249 @@ class MyServer(BaseHTTPRequestHandler):
         
            Parameters: albumID: ID of selected album
         """
-        # get template
-        try:
-            with open(r"..\html\tracks.html") as f:
-                file = f.read()
-        except Exception as e:
-            print(e)
-            self.send_response(500, "Failed")
-            self.end_headers()
-            self.wfile.write(bytes(e, "utf-8"))
-            return
+        self.send_cached_page("/tracks?ID=" + albumID, "tracks", self.tracks_page, albumID)
         
-        # format track data from database
-        table_data = my_albumsdb.get_tracks(albumID)
-        table_row = ""
-        for data in table_data:
-            # data[0] is an int so convert it to string
-            sequence = str(data[0])
-            table_row += "<tr><td>" + sequence + "</td><td>" + data[1] + "</td><td>" + str(data[2]) + "</td></tr>"
-        
-        # add links to top of page (but tracks page only gets 2 links)
-        track_links = ("<a href=http://" + base + "albums>Back</a>\n"
-                       "<a href=http://" + base + ">Logout</a>\n") 
-        file = file.replace("{{links}}", track_links)
-        
-        # replace {{db_records}} in template by table_row
-        file = file.replace("{{db_records}}", table_row)
-        self.send_response(200, "OK")
-        self.end_headers()
-        self.wfile.write(bytes(file, "utf-8"))
+    def tracks_page(self, albumID):
+        """slot values for the tracks template (tracks page only gets 2 links)"""
+        return {"links": track_links, 
+                "db_records": map(track_row, self.db.iter_tracks(albumID))}
     
     def put_album_form(self):
         """display the new album form"""
-        try:
-            with open(r"..\html\add_album_form.html") as f:
-                file = f.read()
-        except Exception as e:
-            print(e)
-            self.send_response(500, "Failed")
-            self.end_headers()
-            self.wfile.write(bytes(e, "utf-8"))
-            return
+        self.send_cached_page("/add_album", "add_album_form", self.album_form_page)
         
-        # build menu list of all valid artists in database
-        # artist menu options need to  look like this: <option value="1">Santana</option>
-        artist_menu_data = my_albumsdb.get_artists()
-        artist_options = ""
-        for artist_data in artist_menu_data:
-            artist_options += "<option value=" + str(artist_data[0]) + ">" + artist_data[1] + "</option>"
-            
-        # build menu list of all valid record labels in database
-        # record label menu options need to look like:  <option value="CBS Records">CBS Records</option>
-        label_menu_data = my_albumsdb.get_labels()
-        label_options = ""
-        for label_data in label_menu_data:
-            label_options += "<option value=" + str(label_data[0]) + ">" + label_data[1] + "</option>"
-            
-        # add links to top of page
-        file = file.replace("{{links}}", links)
-        # replace {{artist_records}} in template by artist_options
-        file = file.replace("{{artist_records}}", artist_options)
-        # replace {{record_labels }} in template by label_options
-        file = file.replace("{{record_labels}}", label_options)
-        
-        self.send_response(200, "OK")
-        self.end_headers()
-        self.wfile.write(bytes(file, "utf-8"))
+    def album_form_page(self):
+        """slot values for the new album form: links, plus menus of all valid 
+           artists and record labels in the database
+        """
+        # the menus are filled in one after the other, so the label query 
+        # only starts once the artist menu has been sent
+        return {"links": links, 
+                "artist_records": map(menu_option, self.db.iter_artists()),
+                "record_labels": map(menu_option, self.db.iter_labels())}
 
     def put_track_form(self):
         """add a track for selected album"""
-        # get template
-        try:
-            with open(r"..\html\add_track_form.html") as f:
-                file = f.read()
-        except Exception as e:
-            print(e)
-            self.send_response(500, "Failed")
-            self.end_headers()
-            self.wfile.write(bytes(e, "utf-8"))
-            return
+        self.send_cached_page("/add_track", "add_track_form", self.track_form_page)
         
-        # build menu list of all valid albums in database
-        # menu options should look like "albumID | album title"
-        album_menu_data = my_albumsdb.get_albums()
-        album_options = ""
-        for album_data in album_menu_data:
-            album_options += "<option value=" + str(album_data[0]) + ">" + album_data[1] + "</option>"
-            
-        # add links to top of page
-        file = file.replace("{{links}}", links)
-        # replace {{artist_records}} in template by artist_options
-        file = file.replace("{{album_records}}", album_options)
-               
-        # replace {{db_records}} in template by album_options
-        #file = file.replace("{{db_records}}", album_options)
-        self.send_response(200, "OK")
-        self.end_headers()
-        self.wfile.write(bytes(file, "utf-8"))
+    def track_form_page(self):
+        """slot values for the add track form: links and a menu of all albums"""
+        return {"links": links, 
+                "album_records": map(menu_option, self.db.iter_albums())}
     
-    def display_unmodified_form(self, display_me):
-        """display a form that does not need any modifications"""
+    def put_tracks_form(self):
+        """form for adding many tracks at once (or uploading a csv file)"""
+        self.send_cached_page("/add_tracks", "add_tracks_form", self.track_form_page)
+        
+    def add_tracks(self):
+        """Add the tracks from the add tracks form: the rows of the form and/or
+           an uploaded csv file in the tracks_initial_load.csv format. cgi 
+           saves an uploaded file to a temporary file as it arrives, and the 
+           csv is read and checked from there a row at a time, in this thread
+           (see albumsDB.add_tracks). Shows how many tracks were added and 
+           what was wrong with the rest.
+        """
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, keep_blank_values=True,
+                                environ={"REQUEST_METHOD": "POST"})
+        added, error_count, errors = self.db.add_tracks(tracks_form_rows(form))
+        
+        summary = f"Added {added} track{'s' if added != 1 else ''}."
+        if error_count:
+            summary += f" {error_count} row{'s' if error_count != 1 else ''} could not be added"
+            if error_count > len(errors):
+                summary += f" (the first {len(errors)} are listed)"
+            summary += ":"
         try:
-            with open(display_me) as f:
-                file = f.read()
-        except Exception as e:
-            print(e)
-            self.send_response(500, "Failed")
-            self.end_headers()
-            self.wfile.write(bytes(e, "utf-8"))
+            template = templates.get("add_tracks_result")
+        except OSError as e:
+            self.send_template_error(e)
             return
+        self.send_page(page_cache.Page(template.render(
+            links=links, summary=summary, db_records=map(error_row, errors))))
         
-        # add links to top of page
-        file = file.replace("{{links}}", links)
+    def display_unmodified_form(self, display_me):
+        """display a form that does not need any modifications
         
-        self.send_response(200, "OK")
-        self.end_headers()
-        self.wfile.write(bytes(file, "utf-8"))
+           Parameters: display_me: name of template to display
+        """
+        self.send_cached_page("/" + display_me, display_me, self.unmodified_form_page)
         
-if __name__ == "__main__":   
-    # connect to database
-    my_albumsdb = albumsdb.albumsDB(database_file)
-    my_albumsdb.connect()
+    def unmodified_form_page(self):
+        """add links to top of page"""
+        return {"links": links}
+        
+def open_database(pool_size):
+    """open database_file with pool_size connections, or exit if it can't be
+       opened
+    """
+    try:
+        db = albumsdb.albumsDB(database_file, pool_size=pool_size, profiler=profiler)
+        db.connect()
+    except (OSError, sqlite3.Error) as e:
+        print(e)
+        sys.exit("Unable to open database " + database_file + ". Program exiting.")
+    return db
+        
+def serve(webServer, pool_size):
+    """connect to the database and serve requests until interrupted. In
+       prefork mode this runs in each worker process, so every process opens
+       its own database connections after the fork.
+       
+       Parameters:
+       webServer: a bound and listening HTTPServer/PooledHTTPServer
+       pool_size: number of database connections to open
+    """
+    global my_albumsdb, profiler, tenant_dbs, request_log
+    if access_log_file:
+        request_log = access_log.AccessLog(access_log_file)
+    if slow_query_ms is not None:
+        profiler = query_profiler.QueryProfiler(slow_query_ms)
+    my_albumsdb = open_database(pool_size)
+    if max_tenants > 0:
+        # tenants start from the snapshot if there is one, otherwise from the database
+        seed_file = snapshot_file if os.path.isfile(snapshot_file) else database_file
+        print(f"Tenant mode: up to {max_tenants} tenant databases in {tenant_dir}, copied from {seed_file}")
+        tenant_dbs = tenants.TenantDatabases(seed_file, tenant_dir, max_tenants, tenant_pool_size,
+                                             profiler, 
+                                             lambda tenant: pages.discard("/t/" + tenant + "/"))
+    templates.preload()
     
-    webServer = HTTPServer((hostname, serverport), MyServer)
-    print(f"Server started http://{hostname}:{serverport}")
- 
     try:
         webServer.serve_forever()
     except KeyboardInterrupt:
         pass
  
+    if tenant_dbs is not None:
+        tenant_dbs.close()
     my_albumsdb.closeDB()
     webServer.server_close()
-    print("Http server stopped.")
\ No newline at end of file
+    if request_log is not None:
+        request_log.close()
+    print(compression.stats.summary())
+    if profiler is not None:
+        print(profiler.report())
+    
+def prefork(webServer, processes, pool_size):
+    """start worker processes that share webServer's listening socket and
+       supervise them. A worker that exits (crashes) is replaced with a new one.
+       Control-C or SIGTERM stops the supervisor and all of the workers.
+       
+       Parameters:
+       webServer: a bound and listening HTTPServer/PooledHTTPServer
+       processes: number of worker processes
+       pool_size: number of database connections per worker process
+    """
+    workers = {}            # pid -> start time
+    
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            # worker process: ignore SIGTERM handler installed for supervisor
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                serve(webServer, pool_size)
+            except BaseException as e:
+                print(f"Worker {os.getpid()} failed: {e}")
+                exit_code = 1
+            os._exit(exit_code)
+        workers[pid] = time.monotonic()
+        
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    
+    for i in range(processes):
+        start_worker()
+    print(f"Started {processes} worker processes")
+    
+    try:
+        while True:
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            # don't spin if a worker dies as soon as it starts
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            start_worker()
+    except KeyboardInterrupt:
+        pass
+    
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    webServer.server_close()
+        
+if __name__ == "__main__":   
+    parser = argparse.ArgumentParser(description="AlbumServer http server")
+    parser.add_argument("--mode", choices=["threaded", "single", "prefork"], default=server_mode,
+                        help="threaded: pool of worker threads, single: one request at a time, "
+                             "prefork: several worker processes, each with a pool of worker threads")
+    parser.add_argument("--workers", type=int, default=worker_threads,
+                        help="number of worker threads (threaded and prefork modes)")
+    parser.add_argument("--processes", type=int, default=worker_processes,
+                        help="number of worker processes (prefork mode)")
+    parser.add_argument("--keepalive-timeout", type=float, default=keepalive_timeout,
+                        help="seconds an idle keep-alive connection is kept open "
+                             "(0 closes the connection after every response)")
+    parser.add_argument("--no-streaming", action="store_true",
+                        help="render each page in full before sending it")
+    parser.add_argument("--slow-query-ms", type=float, default=slow_query_ms,
+                        help="profile database statements and log the ones slower than this")
+    parser.add_argument("--snapshot", default=snapshot_file,
+                        help="snapshot restored by POST /admin/reset (see snapshot.py)")
+    parser.add_argument("--tenants", type=int, default=max_tenants,
+                        help="tenant mode: give each tenant (X-Tenant header or /t/<tenant>/ "
+                             "prefix) its own copy of the database, keeping this many open")
+    parser.add_argument("--tenant-dir", default=tenant_dir,
+                        help="directory for the tenant databases")
+    parser.add_argument("--access-log", default=access_log_file,
+                        help="file for the access log, one JSON object per request "
+                             "(default - for stderr)")
+    parser.add_argument("--no-access-log", action="store_true", help="don't log requests")
+    args = parser.parse_args()
+    
+    if args.no_streaming:
+        streaming = False
+    slow_query_ms = args.slow_query_ms
+    snapshot_file = args.snapshot
+    max_tenants = args.tenants
+    tenant_dir = args.tenant_dir
+    access_log_file = None if args.no_access_log else args.access_log
+    
+    # the single mode server handles one connection at a time, so an idle
+    # keep-alive connection would hold up everyone else. It always closes them.
+    if args.mode == "single" or args.keepalive_timeout <= 0:
+        MyServer.protocol_version = "HTTP/1.0"
+    else:
+        MyServer.timeout = args.keepalive_timeout
+    
+    if args.mode == "prefork" and not hasattr(os, "fork"):
+        sys.exit("prefork mode is not available on this operating system. Program exiting.")
+    if args.mode == "prefork" and max_tenants > 0:
+        # each worker process would make its own copy of every tenant
+        sys.exit("Tenant mode can't be used in prefork mode. Program exiting.")
+    
+    # each worker thread gets its own database connection
+    if args.mode == "single":
+        webServer = HTTPServer((hostname, serverport), MyServer)
+        pool_size = 1
+    else:
+        webServer = PooledHTTPServer((hostname, serverport), MyServer, args.workers)
+        pool_size = args.workers
+    print(f"Server started http://{hostname}:{serverport} ({args.mode} mode)")
+ 
+    if args.mode == "prefork":
+        prefork(webServer, args.processes, pool_size)
+    else:
+        serve(webServer, pool_size)
+    print("Http server stopped.")
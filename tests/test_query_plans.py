@@ -0,0 +1,86 @@
+""" Checks that the server's hot queries use indexes (see migrations.py).
+
+    Builds a database from the csv files in datafiles, applies the schema
+    migrations and runs EXPLAIN QUERY PLAN on every query in
+    migrations.hot_queries(). A query that scans a whole table, or sorts the
+    whole result, fails the test. Run from the AlbumServer directory with:
+
+        python -m pytest tests
+    or
+        python -m unittest discover tests
+
+    Copyright (C) July 2022  Bob Brander
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation version 3. The full license is
+    available here: https://opensource.org/licenses/GPL-3.0
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+"""
+
+import os
+import sqlite3
+import sys
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "src"))
+
+import create_load_albumsdb as loader
+import migrations
+
+datafiles_dir = os.path.join(top_dir, "datafiles")
+
+def load_test_database():
+    """a new in-memory database with the base tables and the csv data"""
+    conn = sqlite3.connect(":memory:")
+    loader.create_tables(conn)
+    for file_name, table_name, insert_sql in loader.load_files:
+        loader.load_csv(conn, table_name, os.path.join(datafiles_dir, file_name), insert_sql)
+    return conn
+
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = load_test_database()
+        migrations.apply_migrations(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_migrated_to_latest_version(self):
+        self.assertEqual(migrations.schema_version(self.conn), migrations.latest_version)
+
+    def test_no_full_scans(self):
+        for name, (plan, scans) in migrations.check_query_plans(self.conn).items():
+            with self.subTest(query=name):
+                self.assertEqual(scans, [], "\n".join(plan))
+
+class LabelCopiesTest(unittest.TestCase):
+
+    def test_albums_moved_to_first_copy(self):
+        conn = sqlite3.connect(":memory:")
+        loader.create_tables(conn)
+        conn.execute("insert into Artists (artist_name) values ('Santana')")
+        conn.executemany("insert into RecordLabels (label_name) values (?)",
+                         [("Columbia",), ("Arista",), ("Columbia",), ("Columbia",)])
+        conn.executemany("insert into Albums (price, album_title, artistRef, year, record_labelRef) "
+                         "values (9.99, ?, 1, 1970, ?)",
+                         [("Abraxas", 3), ("Santana", 4), ("Caravanserai", 1), ("Zebop!", 2)])
+        conn.commit()
+        migrations.apply_migrations(conn)
+
+        self.assertEqual(conn.execute("select record_labelID, label_name from RecordLabels "
+                                      "order by record_labelID").fetchall(),
+                         [(1, "Columbia"), (2, "Arista")])
+        self.assertEqual(conn.execute("select album_title, record_labelRef from Albums "
+                                      "order by albumID").fetchall(),
+                         [("Abraxas", 1), ("Santana", 1), ("Caravanserai", 1), ("Zebop!", 2)])
+        conn.close()
+
+if __name__ == "__main__":
+    unittest.main()